@@ -6,12 +6,23 @@ from datetime import datetime
 import os
 from dotenv import load_dotenv
 import pandas as pd
+import numpy as np
 
 # 匯入模組
 from modules.utils import log
-from modules.api_service import get_positions_df, get_historical_highs
+from modules.api_service import get_positions_df, get_historical_highs, list_stock_accounts
 from modules.logic import monitor_logic
-from modules.chart_utils import draw_stock_chart
+from modules.async_engine import run_async_monitor
+from modules.chart_utils import draw_stock_chart, draw_intraday_chart
+from modules.indicators import IndicatorEngine
+from modules.recorder import SnapshotRecorder
+from modules.data_source import market_data, close_market_data
+from modules.accounts import AccountShardManager
+from modules.universe import UniverseManager, SCANNER_TYPES, load_universe_file, scan_universe
+from modules.pnl import PnLLedger, make_order_callback
+from modules.prefetch import HistoryPrefetcher, market_phase
+from modules.profiler import RerunProfiler, MemoryTracker, profiling_from_env, render_profiler
+from modules.exit_rules import RULE_COLUMNS, MA_OPTIONS, ensure_rule_columns, rules_from_row, rulebook_from_df
 
 # Load environment variables
 load_dotenv(override=True)
@@ -45,6 +56,41 @@ if 'latest_prices' not in st.session_state:
     st.session_state.latest_prices = {}
 if 'stop_monitor_event' not in st.session_state:
     st.session_state.stop_monitor_event = None
+if 'indicators' not in st.session_state:
+    st.session_state.indicators = IndicatorEngine()
+if 'recorder' not in st.session_state:
+    st.session_state.recorder = None
+if 'intraday_charts' not in st.session_state:
+    st.session_state.intraday_charts = {}
+if 'universe' not in st.session_state:
+    st.session_state.universe = UniverseManager()
+if 'accounts' not in st.session_state:
+    st.session_state.accounts = {}
+if 'account_shards' not in st.session_state:
+    st.session_state.account_shards = AccountShardManager()
+if 'profiler' not in st.session_state:
+    st.session_state.profiler = RerunProfiler()
+if 'memory' not in st.session_state:
+    st.session_state.memory = MemoryTracker()
+if 'prefetcher' not in st.session_state:
+    st.session_state.prefetcher = None
+if 'pnl_ledger' not in st.session_state:
+    st.session_state.pnl_ledger = PnLLedger()
+
+# 效能分析 (開關位於側邊欄最下方，或以環境變數 SMARTODER_PROFILE=1 預設開啟)
+prof = st.session_state.profiler
+prof.enabled = st.session_state.get('profiler_enabled', profiling_from_env())
+prof.deep = prof.enabled and st.session_state.get('profiler_deep', False)
+prof.begin_rerun()
+prof.lap("側邊欄 / 登入")
+prof.instrument_api(st.session_state.api)
+if st.session_state.api is not None:
+    prof.instrument_market_data(market_data(st.session_state.api))
+get_positions_df = prof.wrap(get_positions_df)
+get_historical_highs = prof.wrap(get_historical_highs)
+rulebook_from_df = prof.wrap(rulebook_from_df)
+draw_stock_chart = prof.wrap(draw_stock_chart)
+draw_intraday_chart = prof.wrap(draw_intraday_chart)
 
 # ==========================================
 # UI 介面
@@ -108,7 +154,11 @@ if st.sidebar.button("登入並取得庫存"):
     else:
         try:
             # 1. Cleanup previous session if any
+            if st.session_state.prefetcher is not None:
+                st.session_state.prefetcher.stop()
+                st.session_state.prefetcher = None
             if st.session_state.api:
+                close_market_data(st.session_state.api)
                 try:
                     st.session_state.api.logout()
                 except:
@@ -141,7 +191,21 @@ if st.sidebar.button("登入並取得庫存"):
                 )
                 log("憑證驗證成功")
             
+            st.session_state.accounts = list_stock_accounts(st.session_state.api)
+
+            # 成交回報寫入損益帳本 (callback 在 Shioaji 執行緒中執行，日誌直接寫入 list)
+            deal_logs = st.session_state.log_messages
+            def deal_log(message):
+                deal_logs.insert(0, f"[{datetime.now().strftime('%H:%M:%S')}] {message}")
+                if len(deal_logs) > 100:
+                    deal_logs.pop()
+            st.session_state.api.set_order_callback(
+                make_order_callback(st.session_state.pnl_ledger, deal_log))
+            log(f"可用證券帳號: {list(st.session_state.accounts)}")
             st.session_state.logged_in = True
+            # 依交易時段在背景預抓歷史資料 (開盤前 / 收盤後整批，盤中只補缺)
+            st.session_state.prefetcher = HistoryPrefetcher(st.session_state.api, st.session_state.indicators)
+            st.session_state.prefetcher.start()
             st.sidebar.success(f"登入成功！({'模擬' if simulation_mode else '正式'}環境)")
             log(f"系統登入完成")
             st.rerun() # Force rerun to refresh UI state
@@ -165,9 +229,32 @@ if st.sidebar.button("登入並取得庫存"):
                 st.sidebar.error("❌ 連線數過多 (Too Many Connections)，請稍後再試。")
 
 
+# 多帳號選擇 (行情每檔只抓一次，下單依帳號路由)
+selected_accounts = {}
+account_shard_count = 1
+if st.session_state.logged_in and st.session_state.accounts:
+    account_ids = list(st.session_state.accounts)
+    selected_ids = st.sidebar.multiselect(
+        "監控帳號", account_ids, default=account_ids[:1],
+        disabled=st.session_state.monitoring
+    )
+    selected_accounts = {aid: st.session_state.accounts[aid] for aid in selected_ids}
+    if len(selected_ids) > 1:
+        account_shard_count = st.sidebar.number_input(
+            "帳號分片行程數", min_value=1, max_value=len(selected_ids), value=1,
+            disabled=st.session_state.monitoring,
+            help="1 = 在本程式內以單一執行緒監控所有帳號；大於 1 時依持股重疊程度分到多個行程 (各自登入)"
+        )
+if st.session_state.logged_in and st.session_state.api and not selected_accounts:
+    # 未選擇帳號時使用預設證券帳號 (與 get_positions_df 一致)
+    default_account = st.session_state.api.stock_account
+    if default_account is not None:
+        selected_accounts = {default_account.account_id: default_account}
+
 # ==========================================
 
 # --- Main: 主畫面 ---
+prof.lap("策略參數")
 st.title("🤖 庫存智慧監控機器人")
 
 # Status Bar
@@ -204,16 +291,28 @@ with col3:
 
 st.markdown("---")
 
+prof.lap("帳號分片回報")
+
+# 併入帳號分片行程回報的日誌與現價
+st.session_state.account_shards.poll(st.session_state.log_messages, st.session_state.latest_prices,
+                                     st.session_state.pnl_ledger)
+
 # 庫存列表區塊
+prof.lap("庫存刷新")
 st.subheader("2. 庫存清單")
 
 if st.session_state.logged_in and st.session_state.api:
     # 重新整理按鈕 logic
     if st.button("🔄 如果沒看到庫存，請點此重新整理庫存") or st.session_state.positions_df.empty:
-        new_df = get_positions_df(st.session_state.api)
-        if not st.session_state.positions_df.empty and not new_df.empty:
-            old_map = st.session_state.positions_df.set_index('代碼')['長期投資'].to_dict()
-            new_df['長期投資'] = new_df['代碼'].map(old_map).fillna(False)
+        new_df = get_positions_df(st.session_state.api, selected_accounts)
+        if not st.session_state.positions_df.empty and not new_df.empty and '帳號' in st.session_state.positions_df:
+            old_df = ensure_rule_columns(st.session_state.positions_df).set_index(['帳號', '代碼'])
+            new_df = ensure_rule_columns(new_df)
+            new_keys = pd.MultiIndex.from_frame(new_df[['帳號', '代碼']])
+            # 保留使用者於表格中設定的欄位 (依 帳號 + 代碼 對應)
+            for col in ['長期投資', *RULE_COLUMNS]:
+                kept = old_df[col].reindex(new_keys).to_numpy()
+                new_df[col] = pd.Series(kept, index=new_df.index).fillna(new_df[col])
         st.session_state.positions_df = new_df
         
         # [BugFix] 手動刷新後，將最新的現價同步到 latest_prices，避免下方邏輯用 stale data 覆蓋
@@ -221,65 +320,87 @@ if st.session_state.logged_in and st.session_state.api:
             for _, row in new_df.iterrows():
                 st.session_state.latest_prices[row['代碼']] = row['現價']
 
+        # 以券商庫存校正損益帳本 (之後由成交回報與報價增量更新)
+        # (查詢失敗時回傳無欄位的空表，此時不動帳本)
+        if '帳號' in new_df.columns:
+            ledger = st.session_state.pnl_ledger
+            for acc_id, code, qty, cost, price in new_df[['帳號', '代碼', '股數', '成本', '現價']].itertuples(index=False):
+                ledger.sync_position(acc_id, code, int(qty), float(cost), float(price))
+            queried = set(selected_accounts)
+            ledger.drop_missing(queried, set(zip(new_df['帳號'], new_df['代碼'])))
+            ledger.save()
+
     if not st.session_state.positions_df.empty:
         # 更新歷史最高價
+        prof.lap("歷史最高價")
         if '區間最高價' not in st.session_state.positions_df.columns:
              st.session_state.positions_df['區間最高價'] = 0.0
              
         need_fetch_codes = []
         for idx, row in st.session_state.positions_df.iterrows():
-             if row['區間最高價'] == 0:
+             if row['區間最高價'] == 0 and row['代碼'] not in need_fetch_codes:
                  need_fetch_codes.append(row['代碼'])
         
         if need_fetch_codes:
             start_date_str = start_date.strftime("%Y-%m-%d")
-            highs_map = get_historical_highs(st.session_state.api, need_fetch_codes, start_date_str)
+            # 先用指標引擎的快取 (背景預抓)，缺的才查詢
+            highs_map = {}
+            for code in need_fetch_codes:
+                cached_high = st.session_state.indicators.period_high(code, start_date_str)
+                if cached_high is not None:
+                    highs_map[code] = cached_high
+            missing_codes = [code for code in need_fetch_codes if code not in highs_map]
+            prefetcher = st.session_state.prefetcher
+            if missing_codes and prefetcher is not None and market_phase() == "session":
+                # 盤中額度保留給即時報價與下單：交給背景低優先序補齊，下次刷新時帶入
+                prefetcher.request(missing_codes)
+                st.caption(f"⏳ 區間最高價背景補齊中: {missing_codes}")
+            elif missing_codes:
+                highs_map.update(get_historical_highs(st.session_state.api, missing_codes, start_date_str))
             for idx, row in st.session_state.positions_df.iterrows():
                 code = row['代碼']
                 if code in highs_map:
                     st.session_state.positions_df.at[idx, '區間最高價'] = highs_map[code]
-
-        # 計算預估價格
-        for idx, row in st.session_state.positions_df.iterrows():
-            base_high = row['區間最高價']
-            if base_high == 0:
-                base_high = row['現價'] if row['現價'] > 0 else row['成本']
-            
-            current_price = row['現價']
-            if current_price > base_high:
-                base_high = current_price
-            
-            if row['長期投資']:
-                 st.session_state.positions_df.at[idx, '預估出場價'] = 0
-                 st.session_state.positions_df.at[idx, '監控狀態'] = "不監控"
-            else:
-                 st.session_state.positions_df.at[idx, '預估出場價'] = base_high * (1 - trailing_stop / 100)
-                 if st.session_state.monitoring:
-                     st.session_state.positions_df.at[idx, '監控狀態'] = "🔥 監控中"
-                 else:
-                     st.session_state.positions_df.at[idx, '監控狀態'] = "未監控"
-
-        # 使用最新的即時價格更新 DataFrame (如果有)
-        if 'latest_prices' in st.session_state:
-            for idx, row in st.session_state.positions_df.iterrows():
-                code = row['代碼']
-                if code in st.session_state.latest_prices:
-                    # 更新現價
-                    st.session_state.positions_df.at[idx, '現價'] = st.session_state.latest_prices[code]
-                    # 重新計算預估出場價 (因為現價變了，如果現價創高，預估出場價也要變)
-                    # 注意：這裡的邏輯需要跟 monitor_logic 保持一致，或者是純粹顯示
-                    # monitor_logic 裡已經有 trailing stop 邏輯。
-                    # 這裡為了顯示正確，我們重算一次簡單的 (或者直接拿 monitor_logic 的結果? 但 logic 沒存結果)
-                    # 簡單重算：
-                    base_high = row['區間最高價']
-                    current_p = st.session_state.latest_prices[code]
-                    if current_p > base_high:
-                         st.session_state.positions_df.at[idx, '區間最高價'] = current_p
-                         base_high = current_p
-                    
-                    if not row['長期投資']:
-                        st.session_state.positions_df.at[idx, '預估出場價'] = base_high * (1 - trailing_stop / 100)
-
+                    # 同步到指標引擎，啟動監控時不必再重抓歷史
+                    st.session_state.indicators.seed_high(code, highs_map[code], start_date_str)
+
+        prof.lap("預估出場價")
+        df = ensure_rule_columns(st.session_state.positions_df)
+
+        # 使用最新的即時價格更新現價；現價創高時一併更新區間最高價
+        live_prices = df['代碼'].map(st.session_state.latest_prices)
+        # 即時價格同步到指標引擎 (只更新區間最高價與已存在的當日 K 棒；不帶快照時間故不會開新 K 棒)
+        for code, price in zip(df['代碼'], live_prices):
+            if pd.notna(price) and price > 0:
+                st.session_state.indicators.on_price(code, price)
+        df['現價'] = live_prices.fillna(df['現價']).astype(float)
+        df['區間最高價'] = np.where(live_prices.notna() & (df['現價'] > df['區間最高價']),
+                                 df['現價'], df['區間最高價'])
+
+        # 計算預估出場價 (與監控執行緒使用相同的出場規則)
+        base_high = df['區間最高價'].where(df['區間最高價'] > 0,
+                                        df['現價'].where(df['現價'] > 0, df['成本']))
+        base_high = np.maximum(base_high.to_numpy(dtype=float), df['現價'].to_numpy(dtype=float))
+        book = rulebook_from_df(df, trailing_stop)
+        book.update_indicators(st.session_state.indicators)
+        long_term = df['長期投資'].astype(bool).to_numpy()
+        df['預估出場價'] = np.where(long_term, 0.0, book.exit_price(base_high))
+        df['監控狀態'] = np.where(long_term, "不監控",
+                              "🔥 監控中" if st.session_state.monitoring else "未監控")
+
+        # 損益 (帳本增量維護，不需額外查詢券商)
+        ledger = st.session_state.pnl_ledger
+        df['未實現損益'] = [ledger.position_unrealized(a, c) for a, c in zip(df['帳號'], df['代碼'])]
+        ledger.save(min_interval=10)  # 成交回報只標記變更，於 rerun 時節流寫入
+        totals = ledger.totals()
+        col_p1, col_p2, col_p3, col_p4 = st.columns(4)
+        col_p1.metric("未實現損益", f"{totals['unrealized']:,.0f}")
+        col_p2.metric("已實現損益", f"{totals['realized']:,.0f}")
+        col_p3.metric("累計手續費", f"{totals['fees']:,.0f}")
+        col_p4.metric("累計證交稅", f"{totals['taxes']:,.0f}")
+        st.session_state.positions_df = df
+
+        prof.lap("st.data_editor")
         edited_df = st.data_editor(
             st.session_state.positions_df,
             use_container_width=True,
@@ -287,10 +408,20 @@ if st.session_state.logged_in and st.session_state.api:
                 "長期投資": st.column_config.CheckboxColumn("長期投資 (不監控)", default=False),
                 "區間最高價": st.column_config.NumberColumn("區間最高價", format="%.2f"),
                 "預估出場價": st.column_config.NumberColumn("預估出場價", format="%.2f"),
+                "未實現損益": st.column_config.NumberColumn("未實現損益", format="%.0f",
+                                                         help="已扣除預估賣出手續費與證交稅"),
                 "成本": st.column_config.NumberColumn("成本", format="%.2f"),
                 "現價": st.column_config.NumberColumn("現價", format="%.2f"),
+                "移動停損%": st.column_config.NumberColumn("移動停損%", min_value=0.0, format="%.1f",
+                                                        help="空白則使用上方全域設定"),
+                "ATR倍數": st.column_config.NumberColumn("ATR倍數", min_value=0.0, format="%.1f",
+                                                       help="區間最高價 - 倍數 x ATR(14)，0 為不啟用"),
+                "跌破均線": st.column_config.SelectboxColumn("跌破均線", options=list(MA_OPTIONS)),
+                "停損%": st.column_config.NumberColumn("停損%", min_value=0.0, format="%.1f",
+                                                     help="成本 x (1 - %)，0 為不啟用"),
+                "時間出場": st.column_config.TextColumn("時間出場", help="HH:MM，監控期間盤中到時即出場 (啟動時已過該時間則當日不觸發)；空白為不啟用"),
             },
-            disabled=["代碼", "名稱", "股數", "成本", "現價", "監控狀態", "預估出場價", "區間最高價"],
+            disabled=["帳號", "代碼", "名稱", "股數", "成本", "現價", "監控狀態", "預估出場價", "區間最高價", "未實現損益"],
             hide_index=True,
             key="inventory_editor"
         )
@@ -302,7 +433,87 @@ else:
 
 st.markdown("---")
 
+# 觀察清單區塊 (庫存以外的候選標的)
+prof.lap("觀察清單")
+st.subheader("👀 觀察清單 (進出場訊號)")
+if st.session_state.logged_in and st.session_state.api:
+    manager = st.session_state.universe
+    with st.expander("觀察清單設定", expanded=not manager.running):
+        col_u1, col_u2, col_u3 = st.columns(3)
+        with col_u1:
+            universe_source = st.radio("標的來源", ["排行榜 (Scanner)", "上傳檔案"], disabled=manager.running)
+            if universe_source == "上傳檔案":
+                universe_file = st.file_uploader("代碼清單 (.txt / .csv)", type=["txt", "csv"])
+            else:
+                scanner_name = st.selectbox("排行榜", list(SCANNER_TYPES), disabled=manager.running)
+                scanner_count = st.number_input("取前幾名", min_value=10, max_value=200, value=200, step=10)
+        with col_u2:
+            watch_workers = st.slider("工作行程數", min_value=1, max_value=max(1, os.cpu_count() or 1),
+                                      value=min(4, os.cpu_count() or 1), disabled=manager.running,
+                                      help="每個行程各自登入一次，請留意連線數上限")
+            watch_interval = st.number_input("輪詢間隔 (秒)", min_value=1.0, value=3.0, step=1.0)
+        with col_u3:
+            entry_change = st.number_input("進場：漲幅 ≥ (%)", value=3.0, step=0.5)
+            near_high_pct = st.number_input("進場：距當日高點 ≤ (%)", min_value=0.0, value=1.0, step=0.5)
+
+        col_ws, col_wt = st.columns(2)
+        with col_ws:
+            if st.button("▶️ 啟動觀察", disabled=manager.running, use_container_width=True):
+                try:
+                    if universe_source == "上傳檔案":
+                        watch_codes = load_universe_file(universe_file) if universe_file else []
+                    else:
+                        watch_codes = scan_universe(st.session_state.api, scanner_name, int(scanner_count))
+                    if not watch_codes:
+                        st.warning("沒有可觀察的標的")
+                    else:
+                        manager.start(
+                            watch_codes, watch_workers,
+                            {"api_key": api_key, "secret_key": secret_key, "simulation": simulation_mode},
+                            {"trailing_stop": trailing_stop, "entry_change": entry_change,
+                             "near_high_pct": near_high_pct, "interval": watch_interval},
+                        )
+                        log(f"觀察清單啟動：{len(watch_codes)} 檔，{watch_workers} 個行程")
+                        st.rerun()
+                except Exception as e:
+                    st.error(f"啟動觀察失敗: {e}")
+        with col_wt:
+            if st.button("⏹️ 停止觀察", disabled=not manager.running, use_container_width=True):
+                manager.stop()
+                log("觀察清單已停止")
+                st.rerun()
+
+    manager.poll()
+    for err in manager.errors[:3]:
+        st.caption(f"⚠️ {err}")
+    watch_df = manager.view(held_codes=st.session_state.positions_df.get('代碼', []))
+    if not watch_df.empty:
+        only_signals = st.checkbox("只顯示有訊號的標的", value=True)
+        if only_signals:
+            watch_df = watch_df[watch_df['進場訊號'] | watch_df['出場訊號']]
+        st.caption(f"共 {sum(s['檔數'] for s in manager.stats().values())} 檔 | "
+                   + " | ".join(f"shard {k}: {v['檔數']} 檔 {v['每輪(ms)']} ms" for k, v in manager.stats().items()))
+        st.dataframe(watch_df, use_container_width=True, hide_index=True,
+                     column_config={"現價": st.column_config.NumberColumn(format="%.2f"),
+                                    "觀察最高價": st.column_config.NumberColumn(format="%.2f"),
+                                    "漲跌幅%": st.column_config.NumberColumn(format="%.2f")})
+    elif manager.running:
+        st.info("觀察行程啟動中...")
+else:
+    st.info("請先於左側登入以使用觀察清單")
+
+# 背景預抓的代碼：持有部位優先，其次為觀察清單
+if st.session_state.prefetcher is not None:
+    st.session_state.prefetcher.set_symbols(
+        st.session_state.positions_df.get('代碼', []),
+        st.session_state.universe.codes(),
+        start_date.strftime("%Y-%m-%d")
+    )
+
+st.markdown("---")
+
 # 即時日誌區
+prof.lap("日誌")
 st.subheader("📝 即時監控日誌")
 log_container = st.empty()
 text_logs = "\n".join(st.session_state.log_messages)
@@ -311,15 +522,37 @@ if st.session_state.monitoring:
    st.caption("ℹ️ 監控執行中。請手動整理或操作介面查看最新狀態。")
 
 # K線圖檢視區塊
+prof.lap("圖表")
 if st.session_state.logged_in and not st.session_state.positions_df.empty:
     st.markdown("---")
     st.subheader("📈 個股走勢 (K線 + 20MA + 60MA)")
+    chart_mode = st.radio("圖表模式", ["日 K", "盤中 1 分", "盤中 5 分"], horizontal=True)
+    intraday_days = 1
+    if chart_mode != "日 K":
+        intraday_days = st.select_slider("盤中圖顯示交易日數", options=[1, 2, 3, 5], value=1)
     
-    for idx, row in st.session_state.positions_df.iterrows():
+    # 多帳號持有同一檔時只畫一次
+    for idx, row in st.session_state.positions_df.drop_duplicates('代碼').iterrows():
         code = row['代碼']
         name = row['名稱']
         st.markdown(f"**{code} {name}**")
-        draw_stock_chart(st.session_state.api, code, days=100)
+        if chart_mode == "日 K":
+            draw_stock_chart(st.session_state.api, code, days=100,
+                             indicators=st.session_state.indicators,
+                             prefetcher=st.session_state.prefetcher)
+        else:
+            # 監控執行緒寫入指標引擎的最新快照 (含快照時間)
+            quote_price, quote_ts = st.session_state.indicators.last_quote(code)
+            draw_intraday_chart(
+                st.session_state.api, code, name,
+                freq="1min" if chart_mode == "盤中 1 分" else "5min",
+                days=intraday_days,
+                latest_price=quote_price,
+                latest_ts=quote_ts,
+                running_high=row['區間最高價'],
+                exit_price=row['預估出場價'],
+                store=st.session_state.intraday_charts
+            )
         st.markdown("---")
 
 # ==========================================
@@ -346,6 +579,8 @@ if st.session_state.logged_in and not st.session_state.positions_df.empty:
 # 修正：
 # 我們將 Sidebar 的 "按鈕 UI" 保留在上面，但 "按鈕邏輯" 移到下面。
 
+prof.lap("側邊欄控制 / 啟動停止")
+
 # Callback functions
 def on_start_btn_click():
     st.session_state.do_start_monitoring = True
@@ -369,15 +604,35 @@ with st.sidebar:
                  use_container_width=True,
                  on_click=on_stop_btn_click)
             
-    auto_refresh = st.checkbox("監控時自動更新介面", value=True, disabled=not st.session_state.monitoring)
+    use_async_engine = st.checkbox("使用 asyncio 監控核心", value=False,
+                                   disabled=st.session_state.monitoring,
+                                   help="報價、評估、下單與歷史回補分開排程，慢的券商呼叫不會卡住其他工作")
+    auto_refresh = st.checkbox("監控時自動更新介面", value=True,
+                               disabled=not (st.session_state.monitoring or st.session_state.universe.running))
     refresh_seconds = st.slider("刷新間隔 (秒)", min_value=1, max_value=60, value=3, disabled=not auto_refresh)
 
+    if st.session_state.logged_in and st.session_state.api:
+        with st.expander("📡 資料來源狀態"):
+            st.dataframe(pd.DataFrame(market_data(st.session_state.api).status()), hide_index=True)
+        if st.session_state.prefetcher is not None:
+            with st.expander("🗓️ 歷史資料預抓"):
+                st.json(st.session_state.prefetcher.status())
+
+    st.toggle("⏱️ 效能分析模式", value=profiling_from_env(), key="profiler_enabled",
+              help="記錄每次畫面更新各區塊的耗時")
+    if st.session_state.get('profiler_enabled'):
+        st.checkbox("記錄 cProfile / tracemalloc (較慢)", value=False, key="profiler_deep")
+
     st.markdown("---")
     # 登出區
     if st.session_state.logged_in:
         if st.button("👋 登出系統", type="secondary", use_container_width=True):
+            if st.session_state.prefetcher is not None:
+                st.session_state.prefetcher.stop()
+                st.session_state.prefetcher = None
             try:
                 if st.session_state.api:
+                    close_market_data(st.session_state.api)
                     st.session_state.api.logout()
             except Exception as e:
                 pass 
@@ -385,6 +640,8 @@ with st.sidebar:
             st.session_state.logged_in = False
             st.session_state.api = None
             st.session_state.monitoring = False
+            st.session_state.universe.stop()
+            st.session_state.account_shards.stop()
             
             if st.session_state.stop_monitor_event:
                 st.session_state.stop_monitor_event.set()
@@ -404,9 +661,14 @@ if st.session_state.get('do_start_monitoring', False):
     st.toast("收到啟動指令，處理中...") 
     
     monitoring_df = st.session_state.positions_df[~st.session_state.positions_df['長期投資']]
+    # 只監控目前選擇的帳號 (庫存表只在重新整理時重建，可能仍含已取消選擇的帳號)
+    in_selected = monitoring_df['帳號'].isin(selected_accounts)
+    if (~in_selected).any():
+        log(f"帳號 {sorted(set(monitoring_df.loc[~in_selected, '帳號']))} 未選擇，其部位不監控")
+    monitoring_df = monitoring_df[in_selected]
     targets = {}
     for _, row in monitoring_df.iterrows():
-        targets[row['代碼']] = {'cost': row['成本'], 'qty': row['股數']}
+        targets[(row['帳號'], row['代碼'])] = {'cost': row['成本'], 'qty': row['股數'], 'rules': rules_from_row(row)}
     
     if not targets:
         st.sidebar.warning("沒有可監控的標的 (所有庫存皆設為長期投資？)")
@@ -415,33 +677,52 @@ if st.session_state.get('do_start_monitoring', False):
             st.session_state.monitoring = True
             st.session_state.stop_monitor_event = threading.Event()
             
-            log(f"準備啟動監控，標的: {list(targets.keys())}")
-        
-            thread = threading.Thread(
-                target=monitor_logic,
-                args=(
-                    st.session_state.api,
-                    st.session_state.log_messages,
-                    st.session_state.latest_prices,
-                    st.session_state.max_prices,
-                    st.session_state.stop_monitor_event,
-                    trailing_stop, order_type,
-                    targets, 
-                    start_date.strftime("%Y-%m-%d")
-                ),
-                daemon=True
-            )
+            log(f"準備啟動監控，標的: {sorted({code for _, code in targets})}")
+            if st.session_state.recorder is None:
+                st.session_state.recorder = SnapshotRecorder()
+
+            if account_shard_count > 1:
+                # 多帳號分片：各行程自行登入並監控所屬帳號
+                shards = st.session_state.account_shards.start(
+                    targets, int(account_shard_count),
+                    {"api_key": api_key, "secret_key": secret_key, "simulation": simulation_mode,
+                     "pfx_path": pfx_path, "pfx_pass": pfx_pass, "person_id": person_id},
+                    {"trailing_stop": trailing_stop, "order_type": order_type,
+                     "start_date": start_date.strftime("%Y-%m-%d")},
+                )
+                log(f"帳號分片: {shards}")
+                st.toast("監控行程已啟動！")
+                st.rerun()
+            else:
+                thread = threading.Thread(
+                    target=run_async_monitor if use_async_engine else monitor_logic,
+                    args=(
+                        st.session_state.api,
+                        st.session_state.log_messages,
+                        st.session_state.latest_prices,
+                        st.session_state.max_prices,
+                        st.session_state.stop_monitor_event,
+                        trailing_stop, order_type,
+                        targets, 
+                        start_date.strftime("%Y-%m-%d"),
+                        st.session_state.indicators,
+                        st.session_state.recorder,
+                        selected_accounts,
+                        st.session_state.pnl_ledger
+                    ),
+                    daemon=True
+                )
             
-            try:
-                from streamlit.runtime.scriptrunner import add_script_run_ctx
-                add_script_run_ctx(thread)
-            except ImportError:
-                pass 
+                try:
+                    from streamlit.runtime.scriptrunner import add_script_run_ctx
+                    add_script_run_ctx(thread)
+                except ImportError:
+                    pass 
 
-            st.session_state.monitor_thread = thread
-            thread.start()
-            st.toast("監控執行緒已啟動！")
-            st.rerun()
+                st.session_state.monitor_thread = thread
+                thread.start()
+                st.toast("監控執行緒已啟動！")
+                st.rerun()
 
         except Exception as e:
             st.error(f"啟動監控失敗: {e}")
@@ -455,12 +736,29 @@ if st.session_state.get('do_stop_monitoring', False):
     st.session_state.monitoring = False
     if st.session_state.stop_monitor_event:
         st.session_state.stop_monitor_event.set()
+    st.session_state.account_shards.stop()
     log("...正在停止監控...")
     st.rerun()
 
 
-# 監控中自動刷新
-if st.session_state.monitoring and 'auto_refresh' in locals() and auto_refresh:
+# 效能分析結果 (本次 rerun 結算後顯示)
+prof.end_rerun()
+if prof.enabled:
+    st.markdown("---")
+    with st.expander("⏱️ 效能分析 (每次 rerun 各區塊耗時)", expanded=True):
+        render_profiler(prof)
+
+# 記憶體用量 (本次 rerun 結束時取樣：行程 RSS 與本 session 持有的 K 棒 / 表格資料)
+st.session_state.memory.sample(st.session_state)
+mem = st.session_state.memory.report()
+with st.sidebar.expander("🧠 記憶體用量"):
+    if mem.get("rss_peak"):
+        st.caption(f"行程 RSS：目前 {mem['rss']:.0f} MB / 穩定 {mem['rss_steady']:.0f} MB / 峰值 {mem['rss_peak']:.0f} MB")
+    st.caption(f"Session 資料：目前 {mem['session']:.1f} MB / 穩定 {mem['session_steady']:.1f} MB / "
+               f"峰值 {mem['session_peak']:.1f} MB")
+
+# 監控中 (或觀察清單執行中) 自動刷新
+if (st.session_state.monitoring or st.session_state.universe.running) and 'auto_refresh' in locals() and auto_refresh:
     time.sleep(refresh_seconds)
     st.rerun()
 
@@ -0,0 +1,188 @@
+import math
+import multiprocessing as mp
+import queue
+
+from .exit_rules import drop_unresolved_accounts
+from .logic import monitor_logic, book_code
+from .pnl import make_order_callback
+
+
+def shard_accounts(account_symbols, n):
+    """
+    將帳號分配到 n 個 shard，盡量讓持股重疊的帳號落在同一個 shard，
+    使各 shard 需要查詢的相異代碼數最少 (行情每檔只抓一次)。
+    account_symbols: account_id -> 持有代碼集合
+    回傳 list[list[account_id]]
+    """
+    n = max(1, min(n, len(account_symbols)))
+    capacity = math.ceil(len(account_symbols) / n)
+    shards = [[] for _ in range(n)]
+    shard_symbols = [set() for _ in range(n)]
+
+    # 持股多的帳號先分配，挑「新增相異代碼最少」的 shard，平手時挑帳號較少者
+    for account_id in sorted(account_symbols, key=lambda a: -len(account_symbols[a])):
+        symbols = account_symbols[account_id]
+        best = min(
+            (i for i in range(n) if len(shards[i]) < capacity),
+            key=lambda i: (len(symbols - shard_symbols[i]), len(shards[i]))
+        )
+        shards[best].append(account_id)
+        shard_symbols[best] |= symbols
+    return [s for s in shards if s]
+
+
+class QueueLog:
+    """給 monitor_logic 的 log_list 介面，訊息改送到主行程"""
+
+    def __init__(self, out_queue, shard_id):
+        self.out_queue = out_queue
+        self.prefix = f"[shard {shard_id}] "
+
+    def insert(self, index, message):
+        try:
+            self.out_queue.put_nowait(("log", self.prefix + message))
+        except queue.Full:
+            pass
+
+    def pop(self, *args):
+        return None
+
+    def __len__(self):
+        return 0
+
+
+class QueuePrices(dict):
+    """給 monitor_logic 的 latest_prices 介面，現價同時送到主行程"""
+
+    def __init__(self, out_queue):
+        super().__init__()
+        self.out_queue = out_queue
+
+    def __setitem__(self, code, price):
+        super().__setitem__(code, price)
+        try:
+            self.out_queue.put_nowait(("price", code, price))
+        except queue.Full:
+            pass
+
+
+class QueueFills:
+    """給成交回報 callback 的帳本介面，成交改送到主行程的 PnLLedger"""
+
+    def __init__(self, out_queue):
+        self.out_queue = out_queue
+
+    def on_fill(self, *args, **kwargs):
+        try:
+            self.out_queue.put_nowait(("fill", args, kwargs))
+        except queue.Full:
+            pass
+
+
+def account_shard_worker(shard_id, credentials, targets, params, out_queue, stop_event):
+    """帳號分片工作行程：自行登入 (正式環境另需憑證)，對所屬帳號執行 monitor_logic"""
+    import shioaji as sj
+    from shioaji import constant
+
+    log_list = QueueLog(out_queue, shard_id)
+    try:
+        simulation = credentials.get("simulation", True)
+        api = sj.Shioaji(simulation=simulation)
+        api.login(api_key=credentials["api_key"], secret_key=credentials["secret_key"])
+        if not simulation:
+            api.activate_ca(
+                ca_path=credentials["pfx_path"],
+                ca_passwd=credentials["pfx_pass"],
+                person_id=credentials["person_id"]
+            )
+    except Exception as e:
+        log_list.insert(0, f"登入失敗: {e}")
+        return
+    api.set_order_callback(make_order_callback(QueueFills(out_queue), lambda m: log_list.insert(0, m)))
+
+    wanted = {key[0] for key in targets}
+    accounts = {
+        acc.account_id: acc for acc in api.list_accounts()
+        if getattr(acc, "account_type", None) == constant.AccountType.Stock and acc.account_id in wanted
+    }
+    drop_unresolved_accounts(targets, accounts, lambda message: log_list.insert(0, message))
+
+    try:
+        monitor_logic(
+            api, log_list, QueuePrices(out_queue), {}, stop_event,
+            params["trailing_stop"], params["order_type"], targets, params["start_date"],
+            accounts=accounts
+        )
+    finally:
+        try:
+            api.logout()
+        except Exception:
+            pass
+
+
+class AccountShardManager:
+    """
+    多帳號監控分片：帳號數多時依持股重疊程度分到多個行程，
+    每個行程只查詢自己 shard 內的相異代碼，下單依帳號路由。
+    """
+
+    def __init__(self):
+        self.ctx = mp.get_context("spawn")
+        self.processes = []
+        self.stop_event = None
+        self.queue = None
+
+    @property
+    def running(self):
+        return any(p.is_alive() for p in self.processes)
+
+    def start(self, targets, n_shards, credentials, params):
+        """targets: (account_id, code) -> {'cost', 'qty', 'rules'}"""
+        self.stop()
+        account_symbols = {}
+        for key in targets:
+            account_symbols.setdefault(key[0], set()).add(book_code(key))
+
+        self.stop_event = self.ctx.Event()
+        self.queue = self.ctx.Queue(maxsize=10000)
+        shards = shard_accounts(account_symbols, n_shards)
+        for shard_id, account_ids in enumerate(shards):
+            shard_targets = {key: info for key, info in targets.items() if key[0] in account_ids}
+            p = self.ctx.Process(
+                target=account_shard_worker,
+                args=(shard_id, credentials, shard_targets, params, self.queue, self.stop_event),
+                daemon=True,
+                name=f"account-shard-{shard_id}",
+            )
+            p.start()
+            self.processes.append(p)
+        return shards
+
+    def stop(self, timeout=5.0):
+        if self.stop_event is not None:
+            self.stop_event.set()
+        for p in self.processes:
+            p.join(timeout)
+            if p.is_alive():
+                p.terminate()
+        self.processes = []
+
+    def poll(self, log_list, latest_prices, pnl=None):
+        """把各 shard 的日誌、現價與成交併入 Session State (及損益帳本)"""
+        if self.queue is None:
+            return
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except (queue.Empty, OSError, ValueError):
+                break
+            if item[0] == "log":
+                log_list.insert(0, item[1])
+                if len(log_list) > 100:
+                    log_list.pop()
+            elif item[0] == "price":
+                latest_prices[item[1]] = item[2]
+                if pnl is not None:
+                    pnl.on_price(item[1], item[2])
+            elif item[0] == "fill" and pnl is not None:
+                pnl.on_fill(*item[1], **item[2])
@@ -4,42 +4,63 @@ import pandas as pd
 from datetime import datetime
 import streamlit as st
 from .utils import log
-import yfinance as yf # Fallback
+from .data_source import market_data
 
 
-def get_positions_df(api):
-    """取得庫存並轉換為整潔的 DataFrame"""
+def list_stock_accounts(api):
+    """登入身分下可操作的證券帳號 (account_id -> account)，預設帳號排在最前面"""
+    accounts = {}
+    if api.stock_account is not None:
+        accounts[api.stock_account.account_id] = api.stock_account
     try:
-        positions = api.list_positions(unit=constant.Unit.Share)
+        for acc in api.list_accounts():
+            if getattr(acc, "account_type", None) == constant.AccountType.Stock:
+                accounts.setdefault(acc.account_id, acc)
+    except Exception as e:
+        log(f"取得帳號列表失敗: {e}")
+    return accounts
+
+def get_positions_df(api, accounts=None):
+    """
+    取得庫存並轉換為整潔的 DataFrame
+    accounts: account_id -> account (選填，預設為 api.stock_account)。
+              多帳號時同一檔股票在各帳號各佔一列，報價只查詢一次。
+    """
+    try:
+        if not accounts:
+            accounts = {api.stock_account.account_id: api.stock_account}
+
+        valid_positions = []
+        for account_id, account in accounts.items():
+            positions = api.list_positions(account, unit=constant.Unit.Share)
+            valid_positions += [(account_id, p) for p in positions if p.quantity > 0]
         
         # 1. 取得所有庫存代碼的 Snapshot 以獲取最新價格 (list_positions 的價格可能是舊的)
         realtime_prices = {}
-        valid_positions = [p for p in positions if p.quantity > 0]
+        contracts = {}
+        for _, p in valid_positions:
+            if p.code not in contracts:
+                contracts[p.code] = api.Contracts.Stocks.get(p.code)
         
-        if valid_positions:
-            contracts = []
-            for p in valid_positions:
-                contract = api.Contracts.Stocks.get(p.code)
-                if contract:
-                    contracts.append(contract)
-            
-            if contracts:
-                try:
-                    snapshots = api.snapshots(contracts)
-                    for snap in snapshots:
-                        if snap.close > 0:
-                            realtime_prices[snap.code] = snap.close
-                except Exception as e:
-                    log(f"取得即時報價 Snapshot 失敗: {e}")
+        quote_contracts = [c for c in contracts.values() if c]
+        if quote_contracts:
+            snapshots, source = market_data(api).call("quotes", quote_contracts)
+            if snapshots is None:
+                log(f"取得即時報價 Snapshot 失敗: {source}")
+            for snap in snapshots or []:
+                if snap.close > 0:
+                    realtime_prices[snap.code] = snap.close
 
         data = []
-        for p in valid_positions:
+        for account_id, p in valid_positions:
             # 優先使用 Snapshot 的價格，若無則回退到 p.last_price (可能為 0 或昨日收盤)
             real_price = realtime_prices.get(p.code, float(p.last_price) if hasattr(p, 'last_price') else 0.0)
+            contract = contracts.get(p.code)
             
             data.append({
+                "帳號": account_id,
                 "代碼": p.code,
-                "名稱": p.code, # Shioaji Position 物件可能不含名稱，需額外查詢
+                "名稱": contract.name if contract else p.code, # Position 物件不含名稱，由合約補上
                 "股數": int(p.quantity),
                 "成本": float(p.price),
                 "現價": real_price,
@@ -48,29 +69,28 @@ def get_positions_df(api):
             })
         
         if not data:
-            return pd.DataFrame(columns=["代碼", "名稱", "股數", "成本", "現價", "監控狀態", "長期投資", "預估出場價", "區間最高價"])
+            return pd.DataFrame(columns=["帳號", "代碼", "名稱", "股數", "成本", "現價", "監控狀態", "長期投資", "預估出場價", "區間最高價"])
             
         df = pd.DataFrame(data)
         df["預估出場價"] = 0.0
         df["區間最高價"] = 0.0
-        
-        # 嘗試補上股票名稱
-        for index, row in df.iterrows():
-            contract = api.Contracts.Stocks.get(row['代碼'])
-            if contract:
-                df.at[index, '名稱'] = contract.name
-                
         return df
     except Exception as e:
         log(f"取得庫存失敗: {str(e)}")
         return pd.DataFrame()
 
-def place_sell_order(api, code, quantity, order_type_str, reason):
-    """執行賣出下單"""
+def place_sell_order(api, code, quantity, order_type_str, reason, account=None, log_fn=None):
+    """
+    執行賣出下單
+    account: 下單帳號 (預設 api.stock_account)
+    log_fn: 日誌函式 (背景執行緒 / 行程傳入自己的 log)
+    """
+    write_log = log_fn or log
+    account = account or api.stock_account
     try:
         contract = api.Contracts.Stocks.get(code)
         if not contract:
-            log(f"錯誤: 找不到代碼 {code} 的合約資訊")
+            write_log(f"錯誤: 找不到代碼 {code} 的合約資訊")
             return
 
         # 解析 Order Type
@@ -84,11 +104,11 @@ def place_sell_order(api, code, quantity, order_type_str, reason):
         if order_type_str == 'ROD':
             price_type = constant.StockPriceType.LMT
             price = contract.limit_down
-            log(f"下單模式為 ROD，使用跌停價 {price} 以確保成交")
+            write_log(f"下單模式為 ROD，使用跌停價 {price} 以確保成交")
         else:
             price_type = constant.StockPriceType.MKT
             price = 0 # 市價
-            log(f"下單模式為 {order_type_str}，使用市價單")
+            write_log(f"下單模式為 {order_type_str}，使用市價單")
 
         # 建立 Order 物件
         order = api.Order(
@@ -97,53 +117,47 @@ def place_sell_order(api, code, quantity, order_type_str, reason):
             action=constant.Action.Sell,
             price_type=price_type,
             order_type=ord_type,
-            account=api.stock_account
+            account=account
         )
 
         # 送出委託
         trade = api.place_order(contract, order)
-        log(f"【觸發下單】 {reason} | 代碼: {code} | 股數: {quantity} | 模式: {order_type_str}")
+        write_log(f"【觸發下單】 {reason} | 帳號: {account.account_id} | 代碼: {code} | 股數: {quantity} | 模式: {order_type_str}")
         return trade
     except Exception as e:
-        log(f"下單失敗 ({code}): {str(e)}")
+        write_log(f"下單失敗 ({code}): {str(e)}")
 
 def get_historical_highs(api, codes, start_date_str):
     """批次取得股票歷史最高價"""
     results = {}
-    today_str = datetime.now().strftime("%Y-%m-%d")
+    start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
+    today = datetime.now()
+    md = market_data(api)
     
     # 建立進度條
     prog_bar = st.progress(0, text="正在讀取歷史區間最高價...")
     total = len(codes)
     
     for i, code in enumerate(codes):
-        try:
-            contract = api.Contracts.Stocks.get(code)
-            has_data = False
-            
-            # Tier 1: Shioaji API
-            if contract:
-                kbars = api.kbars(contract, start=start_date_str, end=today_str)
-                df_k = pd.DataFrame({**kbars})
-                if not df_k.empty:
-                    results[code] = float(df_k['High'].max())
-                    has_data = True
-            
-            # Tier 2: yfinance Fallback
-            if not has_data:
-                try:
-                    yf_code = f"{code}.TW"
-                    yf_df = yf.download(yf_code, start=start_date_str, end=today_str, progress=False)
-                    if not yf_df.empty and 'High' in yf_df.columns:
-                        h_col = yf_df['High']
-                        results[code] = float(h_col.max())
-                except:
-                    pass
-                    
-        except Exception:
-            pass
+        high, source = md.call("period_high", code, start_date, today)
+        if high is not None:
+            results[code] = high
+        else:
+            log(f"[{code}] 無法取得歷史最高價: {source}")
         prog_bar.progress((i + 1) / total)
         
-    prog_bar.empty()
     prog_bar.empty()
     return results
+
+def get_daily_bars(api, code, start_date, end_date):
+    """
+    取得日 K (Open/High/Low/Close/Volume，index 為日期)
+    Shioaji 回傳分鐘 K，自行轉為日頻率；Shioaji 異常或過慢時改用 yfinance。
+    """
+    df, _ = market_data(api).call("daily_bars", code, start_date, end_date)
+    return df if df is not None else pd.DataFrame()
+
+def get_minute_bars(api, code, start_date, end_date):
+    """取得分鐘 K (Open/High/Low/Close/Volume，index 為時間)，Shioaji 異常或過慢時改用 yfinance 1m"""
+    df, _ = market_data(api).call("minute_bars", code, start_date, end_date)
+    return df if df is not None else pd.DataFrame()
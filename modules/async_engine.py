@@ -0,0 +1,478 @@
+import argparse
+import asyncio
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import numpy as np
+
+from .data_source import backoff_delay
+from .exit_rules import compile_rules, drop_unresolved_accounts
+from .indicators import IndicatorEngine
+
+
+class AsyncMonitor:
+    """
+    asyncio 版監控核心 (參數與 monitor_logic 相同)。
+    報價擷取、出場評估、下單、歷史回補與定期存檔各為一個協作式 task；
+    阻塞的券商呼叫交給有上限的執行緒池，並分道限流：
+    下單最多佔 max_workers - 2 條、歷史回補 1 條，其餘保留給報價，慢的下單或回補不會卡住報價與評估。
+    stop_event (threading.Event) 被設定時取消所有 task；已交給券商的下單會等待完成，
+    尚在排隊的下單則取消並記錄於日誌。
+    啟動時先同步套用指標引擎 (含背景預抓) 快取的區間最高價；沒有快取的標的在回補完成前
+    暫停以最高價為基準的規則 (移動停損 / ATR)，避免以偏低的即時最高價評估。
+
+    quote_fn / history_fn / order_fn 可替換 (測試用)：
+        quote_fn(contracts) -> (snapshots, source)，可為一般函式或 coroutine function
+        history_fn(code, start_dt, end_dt) -> (high, source)
+        order_fn 與 place_sell_order 相同簽名
+    """
+
+    def __init__(self, api, log_list, latest_prices, max_prices, stop_event,
+                 trailing_stop_pct, order_type_str, targets, start_date_str,
+                 indicators=None, recorder=None, accounts=None, pnl=None,
+                 interval=3.0, max_workers=6, checkpoint_interval=30.0,
+                 quote_fn=None, history_fn=None, order_fn=None):
+        self.api = api
+        self.log_list = log_list
+        self.latest_prices = latest_prices
+        self.max_prices = max_prices
+        self.stop_event = stop_event
+        self.trailing_stop_pct = trailing_stop_pct
+        self.order_type_str = order_type_str
+        self.targets = targets
+        self.start_date_str = start_date_str
+        self.indicators = indicators
+        self.recorder = recorder
+        self.accounts = accounts
+        self.pnl = pnl
+        self.interval = interval
+        self.max_workers = max(3, max_workers)
+        self.checkpoint_interval = checkpoint_interval
+
+        if quote_fn is None or history_fn is None:
+            from .data_source import market_data
+            md = market_data(api)
+            quote_fn = quote_fn or (lambda contracts: md.call("quotes", contracts))
+            history_fn = history_fn or (lambda code, start, end: md.call("period_high", code, start, end))
+        if order_fn is None:
+            from .api_service import place_sell_order as order_fn
+        self.quote_fn = quote_fn
+        # 可呼叫物件的 async __call__ 亦視為非同步來源
+        self.quote_async = asyncio.iscoroutinefunction(quote_fn) or \
+            asyncio.iscoroutinefunction(getattr(quote_fn, "__call__", None))
+        self.history_fn = history_fn
+        self.order_fn = order_fn
+
+        self.book = None
+        self.prices = None
+        self.highs = None
+        self.contracts = None
+        self.awaiting_history = set()   # 尚未取得區間最高價的代碼
+        self.inflight = set()   # 下單 task
+        self.sending = set()    # 已交給券商的下單 task
+        # 延遲統計 (秒)
+        self.stats = {name: deque(maxlen=2000) for name in ("cycle", "quote", "eval", "dispatch", "order")}
+        self.quote_at = 0.0
+
+    def log(self, message):
+        timestamp = datetime.now().strftime("%H:%M:%S")
+        self.log_list.insert(0, f"[{timestamp}] {message}")
+        if len(self.log_list) > 100:
+            self.log_list.pop()
+
+    async def offload(self, lane, func, *args):
+        """在執行緒池執行阻塞呼叫；lane 為限流用的 Semaphore"""
+        async with lane:
+            return await self.loop.run_in_executor(self.executor, func, *args)
+
+    # --- tasks ---
+    async def ingest(self):
+        """報價擷取：固定頻率抓取快照，更新現價 / 最高價後喚醒評估"""
+        errors = 0
+        while True:
+            started = time.perf_counter()
+            self.stats["cycle"].append(started)
+            try:
+                if self.contracts is None:
+                    # 只查詢仍有部位在監控中的代碼
+                    self.contracts = [c for c in (self.api.Contracts.Stocks.get(code)
+                                                  for code, rows in self.book.index.items()
+                                                  if self.book.active[rows].any()) if c]
+                if not self.contracts:
+                    raise RuntimeError("無法取得監控標的之合約資訊")
+                if self.quote_async:
+                    snapshots, source = await self.quote_fn(self.contracts)
+                else:
+                    snapshots, source = await self.offload(self.quote_lane, self.quote_fn, self.contracts)
+                if snapshots is None:
+                    raise RuntimeError(f"取得報價失敗: {source}")
+            except Exception as e:
+                self.log(f"報價擷取錯誤: {e}")
+                self.contracts = None
+                await asyncio.sleep(self.interval + backoff_delay(errors, base=2.0))
+                errors += 1
+                continue
+            errors = 0
+
+            received = time.perf_counter()
+            self.stats["quote"].append(received - started)
+            if self.recorder is not None:
+                self.recorder.record(snapshots)
+            for snap in snapshots:
+                code = snap.code
+                price = snap.close
+                if not price:
+                    continue
+                self.latest_prices[code] = price
+                if code not in self.max_prices:
+                    self.max_prices[code] = price
+                    self.log(f"[{code}] 監控開始，初始價格: {price}")
+                elif price > self.max_prices[code]:
+                    self.max_prices[code] = price
+                if self.indicators is not None:
+                    self.indicators.on_price(code, price, getattr(snap, "ts", None))
+                if self.pnl is not None:
+                    self.pnl.on_price(code, price)
+                ready = code not in self.awaiting_history
+                for i in self.book.index.get(code, ()):
+                    self.prices[i] = price
+                    # 最高價為 0 時移動停損 / ATR 規則不會觸發
+                    self.highs[i] = self.max_prices[code] if ready else 0.0
+            self.quote_at = received
+            self.tick.set()
+            await asyncio.sleep(max(0.0, self.interval - (time.perf_counter() - started)))
+
+    async def evaluate(self):
+        """出場評估：每次收到報價即批次評估，觸發的部位交給下單佇列"""
+        book = self.book
+        indicator_refreshed = time.time()
+        while True:
+            await self.tick.wait()
+            self.tick.clear()
+            if book.needs_indicators and time.time() - indicator_refreshed > 60:
+                book.update_indicators(self.indicators)
+                indicator_refreshed = time.time()
+
+            rows, rules, levels = book.evaluate(self.prices, self.highs)
+            fired_at = time.perf_counter()
+            for row, rule, level in zip(rows, rules, levels):
+                book.active[row] = False
+                reason = book.describe(row, rule, self.prices[row], self.highs[row], level)
+                self.orders.put_nowait((book.keys[row], book.codes[row], reason, fired_at))
+            self.stats["eval"].append(time.perf_counter() - self.quote_at)
+
+            if not book.active.any():
+                await self.orders.join()
+                self.log("所有標的已處理完畢，停止監控")
+                self.stop_event.set()
+                return
+
+    async def dispatch(self):
+        """下單：每筆委託各自一個 task，彼此與報價互不阻塞"""
+        while True:
+            key, code, reason, fired_at = await self.orders.get()
+            self.stats["dispatch"].append(time.perf_counter() - fired_at)
+            task = asyncio.create_task(self._place(key, code, reason))
+            self.inflight.add(task)
+            task.add_done_callback(self.inflight.discard)
+
+    async def _place(self, key, code, reason):
+        task = asyncio.current_task()
+        try:
+            account = self.accounts[key[0]] if isinstance(key, tuple) else None
+            async with self.order_lane:
+                self.sending.add(task)
+                started = time.perf_counter()
+                await self.loop.run_in_executor(
+                    self.executor, self.order_fn, self.api, code, self.targets[key]['qty'],
+                    self.order_type_str, reason, account, self.log)
+            self.stats["order"].append(time.perf_counter() - started)
+            # 移除監控 (其他帳號仍持有時保留該檔的最高價與報價)
+            del self.targets[key]
+            if not self.book.active[self.book.index[code]].any():
+                self.max_prices.pop(code, None)
+                self.contracts = None
+        except asyncio.CancelledError:
+            self.log(f"[{code}] 監控停止，取消尚未送出的委託: {reason}")
+            raise
+        except Exception as e:
+            self.log(f"下單處理錯誤 ({code}): {e}")
+        finally:
+            self.sending.discard(task)
+            self.orders.task_done()
+
+    async def backfill(self):
+        """歷史回補：在背景補上沒有快取的區間最高價與日 K 指標，每檔完成後即恢復其最高價規則"""
+        start_dt = datetime.strptime(self.start_date_str, "%Y-%m-%d")
+        for code in [c for c in self.book.index if c in self.awaiting_history]:
+            try:
+                high, source = await self.offload(self.backfill_lane, self.history_fn,
+                                                  code, start_dt, datetime.now())
+            except Exception as e:
+                high, source = None, e
+            if high is not None and high > 0:
+                self.log(f"[{code}] {source} 歷史最高價: {high}")
+                self.max_prices[code] = max(high, self.max_prices.get(code, 0.0))
+                if self.indicators is not None:
+                    self.indicators.seed_high(code, high, self.start_date_str)
+            else:
+                self.log(f"[{code}] ⚠ 查無任何歷史 K 線 ({source})，以即時價格為基準")
+            self._history_ready(code)
+
+        if self.book.needs_indicators:
+            from .api_service import get_daily_bars
+            if self.indicators is None:
+                self.indicators = IndicatorEngine()
+            end_dt = datetime.now()
+            for code in list(self.book.index):
+                if not self.indicators.has_bars(code):
+                    df = await self.offload(self.backfill_lane, get_daily_bars,
+                                            self.api, code, end_dt - timedelta(days=250), end_dt)
+                    self.indicators.ingest_bars(code, df)
+            self.book.update_indicators(self.indicators)
+        self.log("歷史資料回補完成")
+
+    def _apply_cached_highs(self):
+        """同步套用快取的區間最高價，回傳仍需回補的代碼"""
+        missing = set()
+        for code in self.book.index:
+            cached_high = None
+            if self.indicators is not None:
+                cached_high = self.indicators.period_high(code, self.start_date_str)
+            if cached_high is not None:
+                self.max_prices[code] = max(cached_high, self.max_prices.get(code, 0.0))
+            else:
+                missing.add(code)
+        return missing
+
+    def _history_ready(self, code):
+        self.awaiting_history.discard(code)
+        for i in self.book.index.get(code, ()):
+            self.highs[i] = self.max_prices.get(code, 0.0)
+
+    async def checkpoint(self):
+        """定期將快照紀錄與損益帳本寫入磁碟"""
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            await self._checkpoint()
+
+    async def _checkpoint(self):
+        if self.recorder is not None:
+            await self.offload(self.backfill_lane, self.recorder.flush)
+        if self.pnl is not None:
+            await self.offload(self.backfill_lane, self.pnl.save)
+
+    async def watch_stop(self):
+        while not self.stop_event.is_set():
+            await asyncio.sleep(0.1)
+
+    def _on_task_done(self, task):
+        if task.cancelled() or task.exception() is None:
+            return
+        self.log(f"監控 task {task.get_name()} 發生錯誤: {task.exception()}")
+        if task.get_name() != "backfill":
+            self.stop_event.set()
+
+    async def run(self):
+        self.log("=== 監控服務已啟動 (asyncio) ===")
+        drop_unresolved_accounts(self.targets, self.accounts, self.log)
+        if not self.targets:
+            self.log("無監控標的，監控服務停止")
+            self.stop_event.set()
+            return
+
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="monitor-io")
+        self.quote_lane = asyncio.Semaphore(self.max_workers)
+        self.order_lane = asyncio.Semaphore(self.max_workers - 2)
+        self.backfill_lane = asyncio.Semaphore(1)
+        self.tick = asyncio.Event()
+        self.orders = asyncio.Queue()
+
+        self.book = compile_rules(self.targets, self.trailing_stop_pct)
+        self.awaiting_history = self._apply_cached_highs()
+        self.prices = np.zeros(len(self.book))
+        self.highs = np.array([0.0 if code in self.awaiting_history else self.max_prices.get(code, 0.0)
+                               for code in self.book.codes])
+        if self.awaiting_history:
+            self.log(f"{len(self.awaiting_history)} 檔尚無區間最高價快取，回補完成前暫停移動停損 / ATR 規則: "
+                     f"{sorted(self.awaiting_history)}")
+        self.log(f"監控標的共 {len(self.book.index)} 檔 ({len(self.targets)} 個部位): {list(self.book.index)}")
+
+        tasks = []
+        for name, coro in (("ingest", self.ingest()), ("evaluate", self.evaluate()),
+                           ("dispatch", self.dispatch()), ("backfill", self.backfill()),
+                           ("checkpoint", self.checkpoint())):
+            task = asyncio.create_task(coro, name=name)
+            task.add_done_callback(self._on_task_done)
+            tasks.append(task)
+
+        try:
+            await self.watch_stop()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # 已交給券商的委託等待回應，排隊中的取消
+            for task in self.inflight - self.sending:
+                task.cancel()
+            if self.inflight:
+                await asyncio.wait(self.inflight, timeout=15)
+            await self._checkpoint()
+            if sys.version_info >= (3, 9):
+                self.executor.shutdown(wait=False, cancel_futures=True)
+            else:
+                self.executor.shutdown(wait=False)
+            self.log("=== 監控服務已停止 ===")
+
+
+def run_async_monitor(*args, **kwargs):
+    """執行緒函式：以 asyncio 執行 AsyncMonitor (可直接取代 monitor_logic)"""
+    monitor = AsyncMonitor(*args, **kwargs)
+    asyncio.run(monitor.run())
+    return monitor
+
+
+# ==========================================
+# 測試工具：模擬報價來源與券商延遲
+# ==========================================
+
+class FakeQuoteSource:
+    """
+    模擬的非同步報價來源：價格隨機漫步，crash_codes 每輪下跌以觸發出場。
+    latency 為每次報價的延遲 (秒)；blocking=True 時改為阻塞函式 (模擬 Shioaji)。
+    """
+
+    def __init__(self, codes, latency=0.05, crash_codes=(), crash_pct=2.0, seed=0):
+        self.prices = {code: 100.0 for code in codes}
+        self.latency = latency
+        self.crash_codes = set(crash_codes)
+        self.crash_pct = crash_pct
+        self.rng = random.Random(seed)
+
+    def _snapshots(self, contracts):
+        snaps = []
+        for contract in contracts:
+            price = self.prices[contract.code]
+            if contract.code in self.crash_codes:
+                price *= 1 - self.crash_pct / 100
+            else:
+                price *= 1 + self.rng.uniform(-0.002, 0.002)
+            self.prices[contract.code] = price = round(price, 2)
+            snaps.append(SimpleNamespace(code=contract.code, close=price, high=price, low=price,
+                                         total_volume=0, buy_price=price, sell_price=price,
+                                         ts=time.time_ns()))
+        return snaps, "fake"
+
+    async def __call__(self, contracts):
+        await asyncio.sleep(self.latency)
+        return self._snapshots(contracts)
+
+    def blocking(self, contracts):
+        time.sleep(self.latency)
+        return self._snapshots(contracts)
+
+
+class FakeBroker:
+    """模擬券商：下單與歷史查詢皆為阻塞呼叫，延遲可注入"""
+
+    def __init__(self, order_delay=2.0, history_delay=0.5):
+        self.order_delay = order_delay
+        self.history_delay = history_delay
+        self.orders = []
+
+    def place_sell_order(self, api, code, quantity, order_type_str, reason, account=None, log_fn=None):
+        time.sleep(self.order_delay)
+        self.orders.append((code, quantity, reason))
+
+    def period_high(self, code, start_date, end_date):
+        time.sleep(self.history_delay)
+        return 100.0, "fake"
+
+
+def _p95(values):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+def _percentiles(values):
+    if not values:
+        return "n/a"
+    ms = [v * 1000 for v in values]
+    return f"p50={statistics.median(ms):.1f}ms p95={_p95(ms):.1f}ms max={max(ms):.1f}ms n={len(ms)}"
+
+
+def bench(n_symbols=200, n_crash=10, order_delay=2.0, history_delay=0.5, quote_latency=0.05,
+          interval=0.2, duration=8.0, blocking_quotes=False, max_workers=6):
+    """
+    以模擬報價與延遲的券商執行 AsyncMonitor，檢查慢下單 / 慢回補時報價與評估的延遲。
+    回傳 (是否通過, 統計)。
+    """
+    codes = [f"{9000 + i}" for i in range(n_symbols)]
+    crash = codes[:n_crash]
+    api = SimpleNamespace(Contracts=SimpleNamespace(Stocks={c: SimpleNamespace(code=c) for c in codes}))
+    quotes = FakeQuoteSource(codes, latency=quote_latency, crash_codes=crash)
+    broker = FakeBroker(order_delay, history_delay)
+    targets = {("FAKE", code): {"cost": 100.0, "qty": 1000, "rules": {}} for code in codes}
+    accounts = {"FAKE": SimpleNamespace(account_id="FAKE")}
+    log_list, stop_event = [], threading.Event()
+
+    monitor = AsyncMonitor(
+        api, log_list, {}, {}, stop_event, 5.0, "ROD", targets, "2025-01-01", accounts=accounts,
+        interval=interval, max_workers=max_workers,
+        quote_fn=quotes.blocking if blocking_quotes else quotes,
+        history_fn=broker.period_high, order_fn=broker.place_sell_order,
+    )
+    thread = threading.Thread(target=lambda: asyncio.run(monitor.run()), daemon=True)
+    thread.start()
+    time.sleep(duration)
+    stop_event.set()
+    thread.join(order_delay + 20)
+
+    cycles = list(monitor.stats["cycle"])
+    gaps = [b - a for a, b in zip(cycles, cycles[1:])]
+    stats = {name: list(values) for name, values in monitor.stats.items() if name != "cycle"}
+    stats["gap"] = gaps
+    checks = {
+        # 慢下單 / 慢回補期間報價仍維持原本頻率
+        "報價間隔 p95 < interval + 100ms": bool(gaps) and _p95(gaps) < interval + 0.1,
+        # 收到報價到完成評估
+        "評估延遲 max < 50ms": bool(stats["eval"]) and max(stats["eval"]) < 0.05,
+        # 觸發到送出委託 (不排在其他委託之後)
+        "派單延遲 max < 50ms": bool(stats["dispatch"]) and max(stats["dispatch"]) < 0.05,
+        "所有觸發標的皆已下單": sorted(code for code, _, _ in broker.orders) == sorted(crash),
+        "停止後執行緒結束": not thread.is_alive(),
+    }
+    return all(checks.values()), stats, checks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AsyncMonitor 延遲測試 (模擬報價與券商延遲)")
+    parser.add_argument("--symbols", type=int, default=200)
+    parser.add_argument("--crash", type=int, default=10, help="會觸發出場的標的數")
+    parser.add_argument("--order-delay", type=float, default=2.0, help="每筆下單的券商延遲 (秒)")
+    parser.add_argument("--history-delay", type=float, default=0.5, help="每檔歷史查詢延遲 (秒)")
+    parser.add_argument("--quote-latency", type=float, default=0.05)
+    parser.add_argument("--interval", type=float, default=0.2, help="報價輪詢間隔 (秒)")
+    parser.add_argument("--duration", type=float, default=8.0)
+    parser.add_argument("--blocking-quotes", action="store_true", help="報價改為阻塞呼叫 (經執行緒池)")
+    args = parser.parse_args(argv)
+
+    ok, stats, checks = bench(args.symbols, args.crash, args.order_delay, args.history_delay,
+                              args.quote_latency, args.interval, args.duration, args.blocking_quotes)
+    for name in ("gap", "quote", "eval", "dispatch", "order"):
+        print(f"{name:>8}: {_percentiles(stats[name])}")
+    for name, passed in checks.items():
+        print(f"{'PASS' if passed else 'FAIL'}  {name}")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,23 @@
+import time
+
 import streamlit as st
 import pandas as pd
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from datetime import datetime, timedelta
 
-def draw_stock_chart(api, code, days=100):
+from .api_service import get_daily_bars, get_minute_bars
+from .data_source import backoff_delay
+from .prefetch import SESSION_CLOSE, bars_current, last_session_date, market_phase
+
+OHLC_AGG = {'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last', 'Volume': 'sum'}
+
+def draw_stock_chart(api, code, days=100, indicators=None, prefetcher=None):
     """
     繪製個股 K 線圖 + 20MA + 60MA
+    indicators: IndicatorEngine (選填)。提供時 MA 由增量引擎計算，
+                且只抓取引擎最後一根 K 棒之後的資料。
+    prefetcher: HistoryPrefetcher (選填)。盤中快取不足時交由背景低優先序補齊，不直接查詢。
     """
     try:
         contract = api.Contracts.Stocks.get(code)
@@ -17,68 +28,44 @@ def draw_stock_chart(api, code, days=100):
         # 抓取資料：為了計算 60MA，需要抓比 100 天更多的資料 (例如 250 天)
         end_date = datetime.now()
         start_date = end_date - timedelta(days=250) 
+        if indicators is not None:
+            last_bar = indicators.last_bar_date(code)
+            if last_bar is not None:
+                start_date = last_bar.to_pydatetime()
         
-        # Try Shioaji First
-        has_data = False
-        df_daily = pd.DataFrame()
-        
-        try:
-            kbars = api.kbars(
-                contract, 
-                start=start_date.strftime("%Y-%m-%d"), 
-                end=end_date.strftime("%Y-%m-%d")
-            )
-            df = pd.DataFrame({**kbars})
-            
-            if not df.empty:
-                # 轉換為日期格式
-                df['ts'] = pd.to_datetime(df['ts'])
-                df.set_index('ts', inplace=True)
-                
-                # Shioaji API 回傳的是分鐘資料，若要看日 K 需自行轉為日頻率
-                df_daily = df.resample('D').agg({
-                    'Open': 'first',
-                    'High': 'max',
-                    'Low': 'min',
-                    'Close': 'last',
-                    'Volume': 'sum'
-                })
-                # 移除沒有交易的日期 (假日)
-                df_daily.dropna(subset=['Open'], inplace=True)
-                has_data = True
-        except Exception as e:
-            # st.warning(f"API 抓取失敗: {e}")
-            pass
-
-        # Try yfinance Fallback
-        if not has_data:
-            try:
-                import yfinance as yf
-                yf_code = f"{code}.TW"
-                # st.toast(f"切換至 yfinance 抓取 {yf_code}...")
-                df_yf = yf.download(yf_code, start=start_date, end=end_date, progress=False)
-                
-                if not df_yf.empty:
-                     # yfinance 已經是日線，且 Index 是 Datetime
-                     # 欄位名稱通常對應，但可能是 MultiIndex (Price, Ticker)
-                     if isinstance(df_yf.columns, pd.MultiIndex):
-                         df_yf.columns = df_yf.columns.get_level_values(0)
-                         
-                     df_daily = df_yf[['Open', 'High', 'Low', 'Close', 'Volume']].copy()
-                     # yfinance Volume sometimes is 0 for indices, but for stocks it's fine.
-                     has_data = True
-            except Exception as ex:
-                # st.error(f"yfinance 失敗: {ex}")
-                pass
-        
+        # 引擎已涵蓋最近收盤日 (例如開盤前已預抓) 時不再向券商查詢，當日 K 棒由即時價格累積
+        pending_prefetch = False
+        if indicators is not None and bars_current(indicators, code):
+            df_daily = pd.DataFrame()
+        elif indicators is not None and prefetcher is not None and market_phase() == "session":
+            # 盤中額度保留給即時報價與下單：交給背景補齊，下次刷新時帶入
+            prefetcher.request([code])
+            pending_prefetch = True
+            df_daily = pd.DataFrame()
+        else:
+            df_daily = get_daily_bars(api, code, start_date, end_date)
+            if indicators is not None and not df_daily.empty:
+                indicators.mark_checked(code, last_session_date())
+        has_data = not df_daily.empty
+
+        if indicators is not None:
+            # 增量更新指標，圖表直接讀引擎內的歷史
+            if has_data and not df_daily.empty:
+                indicators.ingest_bars(code, df_daily)
+            df_daily = indicators.frame(code)
+            has_data = not df_daily.empty
+
+        if pending_prefetch:
+            st.caption(f"⏳ {code} 日 K 背景補齊中")
         if not has_data or df_daily.empty:
-            st.warning(f"查無 {code} K 線資料 (來源: API & Yahoo)")
+            if not pending_prefetch:
+                st.warning(f"查無 {code} K 線資料 (來源: API & Yahoo)")
             return
 
-        
-        # 計算 MA
-        df_daily['MA60'] = df_daily['Close'].rolling(window=60).mean()
-        df_daily['MA20'] = df_daily['Close'].rolling(window=20).mean()
+        if indicators is None:
+            # 計算 MA
+            df_daily['MA60'] = df_daily['Close'].rolling(window=60).mean()
+            df_daily['MA20'] = df_daily['Close'].rolling(window=20).mean()
         
         # 只取最近 N 天顯示
         df_display = df_daily.tail(days)
@@ -128,3 +115,188 @@ def draw_stock_chart(api, code, days=100):
         
     except Exception as e:
         st.error(f"繪圖發生錯誤: {e}")
+
+
+def decimate_ohlc(df, max_points):
+    """
+    將 K 棒依位置每 k 根合併為一根 (保留 OHLC 語意)，使總數不超過 max_points。
+    用於歷史區段，減少送到瀏覽器的資料量。
+    """
+    n = len(df)
+    if n <= max_points:
+        return df
+    k = -(-n // max_points)
+    groups = pd.Series(range(n), index=df.index) // k
+    out = df.groupby(groups.to_numpy()).agg(OHLC_AGG)
+    out.index = df.index[::k]
+    return out
+
+
+class IntradaySeries:
+    """
+    單一標的的盤中分鐘 K。
+    歷史分鐘 K 下載成功一次後，由盤中即時報價累積到當前分鐘，不再重抓整段 kbars。
+    """
+
+    def __init__(self, code):
+        self.code = code
+        self.history = pd.DataFrame(columns=list(OHLC_AGG))
+        self.live = {}  # minute ts -> [open, high, low, close, volume]
+        self.loaded_days = 0
+        self.failures = 0       # 連續下載失敗次數 (退避用)
+        self.retry_at = 0.0
+        self.last_quote_ts = None
+
+    def load(self, api, days=1):
+        """下載最近 days 個交易日的分鐘 K (已載入足夠天數則略過；失敗時退避後重試)"""
+        if self.loaded_days >= days or time.monotonic() < self.retry_at:
+            return
+        end_date = datetime.now()
+        # 多抓幾天以涵蓋週末/假日，再取最後 days 個交易日
+        start_date = end_date - timedelta(days=days + 4)
+        df = get_minute_bars(api, self.code, start_date, end_date)
+        if not df.empty:
+            sessions = df.index.normalize().unique()[-days:]
+            df = df[df.index.normalize().isin(sessions)]
+            self.history = df
+            # 已被歷史資料涵蓋的即時 K 棒不再重複
+            last = df.index[-1]
+            self.live = {ts: bar for ts, bar in self.live.items() if ts > last}
+            self.loaded_days = days
+            self.failures = 0
+        else:
+            self.retry_at = time.monotonic() + backoff_delay(self.failures, base=5.0, cap=120.0)
+            self.failures += 1
+
+    def on_price(self, price, ts):
+        """
+        以即時報價更新 (或新增) 當前分鐘 K 棒。
+        ts 為快照時間 (epoch ns)；只接受今日盤中的新快照，收盤後或重複的報價不產生 K 棒。
+        """
+        if not price or price <= 0 or ts is None:
+            return
+        if self.last_quote_ts is not None and ts <= self.last_quote_ts:
+            return
+        stamp = pd.Timestamp(ts)
+        if stamp.normalize() != pd.Timestamp.now().normalize() or \
+                market_phase(stamp) != "session" or stamp.time() > SESSION_CLOSE:
+            return
+        self.last_quote_ts = ts
+        minute = stamp.floor("min")
+        if not self.history.empty and minute <= self.history.index[-1]:
+            return
+        bar = self.live.get(minute)
+        if bar is None:
+            self.live[minute] = [price, price, price, price, 0]
+        else:
+            bar[1] = max(bar[1], price)
+            bar[2] = min(bar[2], price)
+            bar[3] = price
+
+    def frame(self, freq="1min"):
+        df = self.history
+        if self.live:
+            live_df = pd.DataFrame.from_dict(self.live, orient="index", columns=list(OHLC_AGG))
+            df = live_df if df.empty else pd.concat([df, live_df])
+        if df.empty or freq == "1min":
+            return df
+        return df.resample(freq, label="left", closed="left").agg(OHLC_AGG).dropna(subset=["Open"])
+
+
+class IntradayChart:
+    """
+    盤中走勢圖。第一次繪製時建立 Figure (歷史區段經過抽樣)，
+    之後只更新最後一根並附加新的 K 棒，以及區間最高價 / 出場價兩條水平線。
+    """
+
+    def __init__(self, code, title, freq="1min", max_points=400):
+        self.code = code
+        self.freq = freq
+        self.max_points = max_points
+        self.fig = None
+        self.last_ts = None
+        self.title = title
+
+    def _build(self, df):
+        hist = decimate_ohlc(df.iloc[:-1], self.max_points - 1)
+        df = pd.concat([hist, df.iloc[-1:]])
+        fig = go.Figure()
+        fig.add_trace(go.Candlestick(
+            x=list(df.index), open=list(df['Open']), high=list(df['High']),
+            low=list(df['Low']), close=list(df['Close']),
+            name=f'{self.freq} K', increasing_line_color='red', decreasing_line_color='green'
+        ))
+        fig.add_trace(go.Scatter(x=[], y=[], mode='lines', name='區間最高價',
+                                 line=dict(color='gold', width=1.2, dash='dot')))
+        fig.add_trace(go.Scatter(x=[], y=[], mode='lines', name='預估出場價',
+                                 line=dict(color='magenta', width=1.5, dash='dash')))
+        fig.update_layout(
+            title=self.title,
+            xaxis_title="時間",
+            yaxis_title="價格",
+            xaxis_rangeslider_visible=False,
+            height=400,
+            template="plotly_dark"
+        )
+        self.fig = fig
+
+    def _append(self, df):
+        """從上次最後一根 (可能仍在變動) 開始更新，其餘附加在尾端"""
+        new = df[df.index >= self.last_ts]
+        if new.empty:
+            return
+        candle = self.fig.data[0]
+        keep = len(candle.x) - 1 if new.index[0] == self.last_ts else len(candle.x)
+        candle.x = tuple(candle.x[:keep]) + tuple(new.index)
+        candle.open = tuple(candle.open[:keep]) + tuple(new['Open'])
+        candle.high = tuple(candle.high[:keep]) + tuple(new['High'])
+        candle.low = tuple(candle.low[:keep]) + tuple(new['Low'])
+        candle.close = tuple(candle.close[:keep]) + tuple(new['Close'])
+
+    def update(self, df, running_high=None, exit_price=None):
+        if df.empty:
+            return
+        if self.fig is None:
+            self._build(df)
+        else:
+            self._append(df)
+        self.last_ts = df.index[-1]
+
+        x_range = [self.fig.data[0].x[0], self.last_ts]
+        for trace, level in ((self.fig.data[1], running_high), (self.fig.data[2], exit_price)):
+            if level and level > 0:
+                trace.x, trace.y = x_range, [level, level]
+            else:
+                trace.x, trace.y = [], []
+
+
+def draw_intraday_chart(api, code, name, freq="1min", days=1, latest_price=None, latest_ts=None,
+                        running_high=None, exit_price=None, store=None):
+    """
+    繪製盤中分鐘 K，並標示區間最高價與預估出場價。
+    latest_price / latest_ts: 最新報價與其快照時間 (epoch ns)，沒有快照時間則不累積即時 K 棒
+    store: 跨 rerun 保存 IntradaySeries / IntradayChart 的 dict (例如 st.session_state 中的一個 dict)
+    """
+    try:
+        store = store if store is not None else {}
+        series = store.get(('series', code))
+        if series is None:
+            series = store[('series', code)] = IntradaySeries(code)
+        series.load(api, days)
+        if latest_price:
+            series.on_price(latest_price, latest_ts)
+
+        df = series.frame(freq)
+        if df.empty:
+            st.warning(f"查無 {code} 盤中分鐘資料")
+            return
+
+        key = ('chart', code, freq, days)
+        chart = store.get(key)
+        if chart is None:
+            chart = store[key] = IntradayChart(code, f"{code} {name} - 盤中 {freq} 走勢", freq)
+        chart.update(df, running_high, exit_price)
+        st.plotly_chart(chart.fig, use_container_width=True)
+
+    except Exception as e:
+        st.error(f"繪圖發生錯誤: {e}")
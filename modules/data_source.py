@@ -0,0 +1,353 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import timedelta
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+OHLCV = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+# K 棒欄位的精簡型別 (台股價格 float32 已足夠，單根成交量不超過 int32)
+BAR_DTYPES = {'Open': np.float32, 'High': np.float32, 'Low': np.float32,
+              'Close': np.float32, 'Volume': np.int32}
+
+
+def backoff_delay(attempt, base=1.0, cap=30.0):
+    """指數退避 + full jitter：在 [0, min(cap, base * 2^attempt)] 之間隨機等待"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    """
+    每個資料來源一個斷路器。
+    連續失敗達 failure_threshold 次即開啟 (暫停使用)，reset_timeout 秒後放行一次試探 (half-open)，
+    試探成功即恢復，失敗則再次開啟。
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class SourceHealth:
+    """資料來源健康度：成功/失敗次數、各操作的 EWMA 延遲與最後錯誤"""
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.latency = {}
+        self.successes = 0
+        self.failures = 0
+        self.last_error = ""
+
+    def observe(self, op, latency, ok, error=None):
+        if ok:
+            self.successes += 1
+            prev = self.latency.get(op)
+            self.latency[op] = latency if prev is None else (
+                self.alpha * latency + (1 - self.alpha) * prev)
+        else:
+            self.failures += 1
+            self.last_error = str(error)
+
+
+class ShioajiSource:
+    """Tier 1: 永豐金 Shioaji API"""
+
+    name = "Shioaji"
+    fallback_ops = frozenset()
+
+    def __init__(self, api, timeout=10.0):
+        self.api = api
+        self.timeout_ms = int(timeout * 1000)
+
+    def minute_bars(self, code, start_date, end_date, columns=OHLCV):
+        contract = self.api.Contracts.Stocks.get(code)
+        if not contract:
+            raise LookupError(f"找不到代碼 {code} 的合約")
+        kbars = self.api.kbars(
+            contract,
+            start=start_date.strftime("%Y-%m-%d"),
+            end=end_date.strftime("%Y-%m-%d"),
+            timeout=self.timeout_ms
+        )
+        return kbars_frame(kbars, columns)
+
+    def daily_bars(self, code, start_date, end_date):
+        df = self.minute_bars(code, start_date, end_date)
+        if df.empty:
+            return df
+        # Shioaji 回傳分鐘資料，自行轉為日頻率並移除沒有交易的日期 (假日)
+        df_daily = df.resample('D').agg({
+            'Open': 'first',
+            'High': 'max',
+            'Low': 'min',
+            'Close': 'last',
+            'Volume': 'sum'
+        })
+        # 單日成交量加總改用 int64 避免溢位
+        return df_daily.dropna(subset=['Open']).astype({'Volume': np.int64})
+
+    def period_high(self, code, start_date, end_date):
+        df = self.minute_bars(code, start_date, end_date, columns=['High'])
+        # float32 轉回兩位小數的價格 (台股最小跳動單位 0.01)
+        return round(float(df['High'].max()), 2) if not df.empty else None
+
+    def quotes(self, contracts):
+        return self.api.snapshots(contracts, timeout=self.timeout_ms)
+
+
+class YFinanceSource:
+    """Tier 2: yfinance (上市股票以 .TW 查詢)"""
+
+    name = "yfinance"
+    # 報價有延遲且逐檔下載慢，不作為 hedge 對象；只在主要來源斷路器開啟時備援
+    fallback_ops = frozenset({"quotes"})
+
+    @staticmethod
+    def _download(code, start, end, **kwargs):
+        import yfinance as yf
+        df = yf.download(f"{code}.TW", start=start, end=end, progress=False, **kwargs)
+        if df.empty:
+            return df
+        # yfinance 欄位可能是 MultiIndex (Price, Ticker)
+        if isinstance(df.columns, pd.MultiIndex):
+            df.columns = df.columns.get_level_values(0)
+        if df.index.tz is not None:
+            df.index = df.index.tz_convert("Asia/Taipei").tz_localize(None)
+        return df[OHLCV].copy()
+
+    def minute_bars(self, code, start_date, end_date):
+        # 1m 資料僅提供近 7 日；end 為不含當日，因此加一天
+        return self._download(code, start_date, end_date + timedelta(days=1), interval="1m")
+
+    def daily_bars(self, code, start_date, end_date):
+        return self._download(code, start_date, end_date + timedelta(days=1))
+
+    def period_high(self, code, start_date, end_date):
+        df = self.daily_bars(code, start_date, end_date)
+        return float(df['High'].max()) if not df.empty else None
+
+    def quotes(self, contracts):
+        """以最近一日的 1m K 近似快照 (欄位與 Shioaji snapshot 相容的子集)，所有代碼一次批次下載"""
+        import yfinance as yf
+        tickers = [f"{contract.code}.TW" for contract in contracts]
+        if not tickers:
+            return []
+        data = yf.download(tickers, period="1d", interval="1m", progress=False, group_by="ticker")
+        if data.empty:
+            return []
+        results = []
+        for contract, ticker in zip(contracts, tickers):
+            if isinstance(data.columns, pd.MultiIndex):
+                if ticker not in data.columns.get_level_values(0):
+                    continue
+                df = data[ticker]
+            else:
+                df = data
+            df = df.dropna(subset=['Close'])
+            if df.empty:
+                continue
+            # 與 Shioaji 相同，ts 為台北當地時間的 epoch ns (不含時區)
+            last = df.index[-1]
+            if last.tzinfo is not None:
+                last = last.tz_convert("Asia/Taipei").tz_localize(None)
+            results.append(SimpleNamespace(
+                code=contract.code,
+                ts=int(last.value),
+                close=float(df['Close'].iloc[-1]),
+                high=float(df['High'].max()),
+                low=float(df['Low'].min()),
+                total_volume=int(df['Volume'].sum()),
+                buy_price=0.0,
+                sell_price=0.0,
+            ))
+        return results
+
+
+def kbars_frame(kbars, columns=OHLCV):
+    """
+    將 Shioaji kbars 直接轉為精簡型別的 DataFrame (索引為 ts)。
+    ts 以 int64 epoch ns 直接轉 datetime64，OHLC 為 float32、Volume 為 int32；
+    只轉換 columns 指定的欄位 (例如區間最高價只需 ['High'])，不經過 {**kbars} 的整份複製。
+    """
+    def field(name):
+        return kbars[name] if isinstance(kbars, dict) else getattr(kbars, name)
+
+    ts = np.asarray(field('ts'), dtype=np.int64)
+    index = pd.DatetimeIndex(ts.view('datetime64[ns]'), name='ts')
+    data = {col: np.asarray(field(col), dtype=BAR_DTYPES[col]) for col in columns}
+    return pd.DataFrame(data, index=index, columns=list(columns), copy=False)
+
+
+def _is_empty(result):
+    if result is None:
+        return True
+    if isinstance(result, pd.DataFrame):
+        return result.empty
+    if isinstance(result, (list, tuple, dict)):
+        return len(result) == 0
+    return False
+
+
+class MarketData:
+    """
+    具備健康度追蹤、斷路器與 hedged request 的多來源資料層。
+    依序嘗試可用的來源；主要來源超過 hedge 門檻仍未回應時，同時向下一個來源發出請求，
+    取最先成功的結果。整體等待時間不超過 timeout。
+    來源的 fallback_ops 只在其他來源斷路器皆開啟時使用 (不 hedge)；
+    每個來源各自一個執行緒池，備援請求不會排在卡住的主要請求後面。
+    """
+
+    def __init__(self, sources, hedge_after=3.0, min_hedge=0.3, timeout=12.0, max_workers=8):
+        self.sources = list(sources)
+        self.breakers = {s.name: CircuitBreaker() for s in self.sources}
+        self.health = {s.name: SourceHealth() for s in self.sources}
+        self.hedge_after = hedge_after
+        self.min_hedge = min_hedge
+        self.timeout = timeout
+        self.executors = {
+            s.name: ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"market-data-{s.name}")
+            for s in self.sources
+        }
+
+    def _hedge_delay(self, source, op):
+        """依該來源此操作的平均延遲決定多久後送出備援請求"""
+        latency = self.health[source.name].latency.get(op)
+        if latency is None:
+            return self.hedge_after
+        return min(self.hedge_after, max(self.min_hedge, latency * 2))
+
+    def _run(self, source, op, args):
+        start = time.monotonic()
+        try:
+            result = getattr(source, op)(*args)
+        except Exception as e:
+            self.health[source.name].observe(op, time.monotonic() - start, False, e)
+            self.breakers[source.name].record_failure()
+            raise
+        self.health[source.name].observe(op, time.monotonic() - start, True)
+        self.breakers[source.name].record_success()
+        return result
+
+    def call(self, op, *args):
+        """
+        執行 op (minute_bars / daily_bars / period_high / quotes)。
+        回傳 (結果, 來源名稱)；所有來源皆失敗或無資料時回傳 (None, 錯誤說明)。
+        """
+        allowed = [s for s in self.sources if self.breakers[s.name].allow()]
+        candidates = [s for s in allowed if op not in s.fallback_ops] or allowed
+        if not candidates:
+            return None, "所有資料來源暫停中 (斷路器開啟)"
+
+        deadline = time.monotonic() + self.timeout
+        pending = {}
+        errors = []
+        next_idx = 0
+
+        def launch():
+            nonlocal next_idx
+            source = candidates[next_idx]
+            next_idx += 1
+            pending[self.executors[source.name].submit(self._run, source, op, args)] = source
+            return source
+
+        current = launch()
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            wait_for = remaining
+            if next_idx < len(candidates):
+                wait_for = min(remaining, self._hedge_delay(current, op))
+            done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+
+            if not done:
+                # 超過 hedge 門檻：向下一個來源同時發出請求
+                if next_idx < len(candidates):
+                    current = launch()
+                continue
+
+            for future in done:
+                source = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors.append(f"{source.name}: {e}")
+                    continue
+                if not _is_empty(result):
+                    return result, source.name
+                errors.append(f"{source.name}: 無資料")
+
+            # 已完成的來源都沒有結果，若尚無其他請求在途則立即改試下一個
+            if not pending and next_idx < len(candidates):
+                current = launch()
+
+        if pending:
+            errors.append("逾時")
+        return None, "; ".join(errors) or "無資料"
+
+    def status(self):
+        """各來源健康度 (供 UI 顯示)"""
+        rows = []
+        for s in self.sources:
+            h = self.health[s.name]
+            rows.append({
+                "來源": s.name,
+                "狀態": self.breakers[s.name].state,
+                "成功": h.successes,
+                "失敗": h.failures,
+                "平均延遲(s)": ", ".join(f"{op}={v:.2f}" for op, v in h.latency.items()),
+                "最後錯誤": h.last_error,
+            })
+        return rows
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def market_data(api):
+    """取得 (或建立) 與此 API 連線綁定的 MarketData"""
+    with _registry_lock:
+        md = _registry.get(id(api))
+        if md is None or md.sources[0].api is not api:
+            md = MarketData([ShioajiSource(api), YFinanceSource()])
+            _registry[id(api)] = md
+        return md
+
+
+def close_market_data(api):
+    """登出時釋放此 API 連線的 MarketData"""
+    with _registry_lock:
+        md = _registry.pop(id(api), None)
+    if md is not None:
+        for executor in md.executors.values():
+            executor.shutdown(wait=False)
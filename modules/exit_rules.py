@@ -0,0 +1,211 @@
+import math
+from datetime import datetime
+
+import numpy as np
+
+from .prefetch import SESSION_CLOSE, market_phase
+
+# 庫存表中可編輯的出場規則欄位與預設值
+RULE_COLUMNS = {
+    "移動停損%": math.nan,  # 空白 = 使用全域設定
+    "ATR倍數": 0.0,         # 0 = 不啟用；出場價 = 區間最高價 - 倍數 * ATR
+    "跌破均線": "無",        # 無 / MA20 / MA60
+    "停損%": 0.0,           # 0 = 不啟用；出場價 = 成本 * (1 - % / 100)
+    "時間出場": "",          # HH:MM，空白 = 不啟用
+}
+
+MA_OPTIONS = {"無": 0, "MA20": 20, "MA60": 60}
+
+# 規則順序同 RuleBook.levels 的列
+RULE_NAMES = ["移動停損", "ATR 停損", "跌破均線", "固定停損", "時間出場"]
+TIME_RULE = len(RULE_NAMES) - 1
+
+
+def ensure_rule_columns(df):
+    """補上缺少的出場規則欄位"""
+    for col, default in RULE_COLUMNS.items():
+        if col not in df.columns:
+            df[col] = default
+    return df
+
+
+def rules_from_row(row):
+    """由庫存表的一列取出出場規則設定"""
+    return {col: row.get(col, default) for col, default in RULE_COLUMNS.items()}
+
+
+def _parse_time(value):
+    """'HH:MM' -> 當日分鐘數；無效或空白回傳 inf"""
+    if not isinstance(value, str) or not value.strip():
+        return math.inf
+    try:
+        hh, mm = value.strip().split(":")
+        return int(hh) * 60 + int(mm)
+    except ValueError:
+        return math.inf
+
+
+def _as_float(value, default=0.0):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return default
+    return default if math.isnan(value) else value
+
+
+class RuleBook:
+    """
+    將每個部位的出場規則編譯為欄位陣列，每輪一次以向量運算評估所有標的。
+    每一列 (row) 對應一個監控部位，codes 可重複 (例如多帳號持有同一檔)。
+    """
+
+    def __init__(self, codes, trail_pct, atr_mult, ma_window, stop_price, time_exit, keys=None):
+        self.codes = list(codes)
+        # 每列原始的 targets key (單帳號為代碼，多帳號為 (帳號, 代碼))
+        self.keys = list(keys) if keys is not None else list(self.codes)
+        n = len(self.codes)
+        self.trail_pct = np.asarray(trail_pct, dtype=float)
+        self.atr_mult = np.asarray(atr_mult, dtype=float)
+        self.ma_window = np.asarray(ma_window, dtype=int)
+        self.stop_price = np.asarray(stop_price, dtype=float)
+        self.time_exit = np.asarray(time_exit, dtype=float)
+        self.active = np.ones(n, dtype=bool)
+        # 時間出場：本次監控期間於盤中跨過設定時間者 (跨日重置)
+        self.time_due = np.zeros(n, dtype=bool)
+        self.last_eval = None
+        # 由指標引擎填入，未知時為 NaN (該規則不觸發)
+        self.atr = np.full(n, np.nan)
+        self.ma20 = np.full(n, np.nan)
+        self.ma60 = np.full(n, np.nan)
+        self.index = {}
+        for i, code in enumerate(self.codes):
+            self.index.setdefault(code, []).append(i)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def needs_indicators(self):
+        return bool(np.any(self.atr_mult > 0) or np.any(self.ma_window > 0))
+
+    def update_indicators(self, indicators):
+        """從 IndicatorEngine 讀取已完成 K 棒的 ATR / MA (每檔一次)"""
+        for code, rows in self.index.items():
+            values = indicators.live(code)
+            for i in rows:
+                self.atr[i] = values.get("ATR", np.nan)
+                self.ma20[i] = values.get("MA20", np.nan)
+                self.ma60[i] = values.get("MA60", np.nan)
+
+    def levels(self, high):
+        """各價格型規則的出場價，shape = (規則數 - 1, 列數)；未啟用為 -inf"""
+        high = np.asarray(high, dtype=float)
+        out = np.full((TIME_RULE, len(self.codes)), -np.inf)
+        with np.errstate(invalid="ignore"):
+            out[0] = np.where(self.trail_pct > 0, high * (1 - self.trail_pct / 100), -np.inf)
+            atr_level = high - self.atr_mult * self.atr
+            out[1] = np.where((self.atr_mult > 0) & np.isfinite(atr_level), atr_level, -np.inf)
+            ma = np.where(self.ma_window == 20, self.ma20,
+                          np.where(self.ma_window == 60, self.ma60, np.nan))
+            out[2] = np.where(np.isfinite(ma), ma, -np.inf)
+        out[3] = self.stop_price
+        return out
+
+    def exit_price(self, high):
+        """最先會觸發的出場價 (各價格型規則中最高者)；皆未啟用時為 0"""
+        best = self.levels(high).max(axis=0)
+        return np.where(np.isfinite(best), best, 0.0)
+
+    def evaluate(self, price, high, now=None):
+        """
+        一次評估所有列。
+        price / high: 與 codes 對齊的陣列 (price <= 0 視為無報價)
+        回傳 (觸發列索引陣列, 觸發規則索引陣列, 該規則出場價陣列)
+        """
+        price = np.asarray(price, dtype=float)
+        now = now or datetime.now()
+        now_min = now.hour * 60 + now.minute
+        in_session = market_phase(now) == "session" and now.time() < SESSION_CLOSE
+
+        # 時間出場只在盤中、且於監控期間跨過設定時間才觸發；
+        # 啟動時已過設定時間 (或收盤後) 不會立即送出賣單
+        if self.last_eval is None:
+            prev_min = now_min
+        elif self.last_eval.date() != now.date():
+            self.time_due[:] = False
+            prev_min = -1
+        else:
+            prev_min = self.last_eval.hour * 60 + self.last_eval.minute
+        self.last_eval = now
+        if in_session:
+            self.time_due |= (prev_min < self.time_exit) & (self.time_exit <= now_min)
+
+        levels = self.levels(high)
+        valid = self.active & (price > 0)
+        hits = np.empty((len(RULE_NAMES), len(self.codes)), dtype=bool)
+        hits[:TIME_RULE] = price <= levels
+        hits[TIME_RULE] = self.time_due & in_session
+        hits &= valid
+
+        fired = hits.any(axis=0)
+        rows = np.flatnonzero(fired)
+        reasons = hits[:, rows].argmax(axis=0)
+        fired_levels = np.where(reasons < TIME_RULE,
+                                levels[np.minimum(reasons, TIME_RULE - 1), rows], np.nan)
+        return rows, reasons, fired_levels
+
+    def describe(self, row, rule, price, high, level):
+        """觸發原因說明 (只在觸發時呼叫)"""
+        code = self.codes[row]
+        name = RULE_NAMES[rule]
+        if rule == 0:
+            return f"觸發{name} (現價 {price} <= 防守價 {level:.2f}, 波段最高 {high})"
+        if rule == TIME_RULE:
+            return f"觸發{name} ({code} 已達設定出場時間)"
+        return f"觸發{name} (現價 {price} <= 出場價 {level:.2f})"
+
+
+def drop_unresolved_accounts(targets, accounts, log):
+    """
+    (帳號, 代碼) 的部位必須能在 accounts 找到帳號才監控；找不到的移除並記錄，
+    絕不改用預設帳號下單。回傳被移除的帳號集合。
+    """
+    accounts = accounts or {}
+    missing = {key[0] for key in targets if isinstance(key, tuple) and key[0] not in accounts}
+    if missing:
+        log(f"找不到帳號 {sorted(missing)}，其部位將不監控")
+        for key in [k for k in targets if isinstance(k, tuple) and k[0] in missing]:
+            del targets[key]
+    return missing
+
+
+def compile_rules(targets, default_trailing_pct):
+    """
+    將監控標的 (code 或 (account_id, code) -> {'cost', 'qty', 'rules'}) 編譯為 RuleBook。
+    未設定 rules 的標的只使用全域移動停損。
+    """
+    return _compile_rows(targets.items(), default_trailing_pct)
+
+
+def _compile_rows(rows, default_trailing_pct):
+    keys, codes, trail, atr_mult, ma_window, stop_price, time_exit = [], [], [], [], [], [], []
+    for key, info in rows:
+        rules = info.get("rules") or {}
+        keys.append(key)
+        codes.append(key[-1] if isinstance(key, tuple) else key)
+        trail.append(_as_float(rules.get("移動停損%"), default_trailing_pct))
+        atr_mult.append(_as_float(rules.get("ATR倍數")))
+        ma_window.append(MA_OPTIONS.get(rules.get("跌破均線"), 0))
+        stop_pct = _as_float(rules.get("停損%"))
+        stop_price.append(info["cost"] * (1 - stop_pct / 100) if stop_pct > 0 else -np.inf)
+        time_exit.append(_parse_time(rules.get("時間出場")))
+    return RuleBook(codes, trail, atr_mult, ma_window, stop_price, time_exit, keys=keys)
+
+
+def rulebook_from_df(df, default_trailing_pct):
+    """由庫存表 (含出場規則欄位) 直接編譯，供 UI 計算預估出場價"""
+    rows = [
+        (row["代碼"], {"cost": row["成本"], "qty": row["股數"], "rules": rules_from_row(row)})
+        for row in df.to_dict("records")
+    ]
+    return _compile_rows(rows, default_trailing_pct)
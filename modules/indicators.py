@@ -0,0 +1,298 @@
+from collections import deque
+from datetime import datetime
+import threading
+import math
+
+import pandas as pd
+
+from .prefetch import market_phase
+
+
+class RollingMean:
+    """固定視窗移動平均，維護累計和，每次更新 O(1)"""
+
+    def __init__(self, window):
+        self.window = window
+        self.values = deque()
+        self.total = 0.0
+
+    def push(self, value):
+        self.values.append(value)
+        self.total += value
+        if len(self.values) > self.window:
+            self.total -= self.values.popleft()
+
+    @property
+    def ready(self):
+        return len(self.values) >= self.window
+
+    @property
+    def value(self):
+        if not self.ready:
+            return math.nan
+        return self.total / self.window
+
+    def peek(self, value):
+        """若下一筆為 value 時的均值 (盤中未收盤的暫定值)，不改變狀態"""
+        n = len(self.values)
+        if n + 1 < self.window:
+            return math.nan
+        total = self.total + value
+        if n >= self.window:
+            total -= self.values[0]
+        return total / self.window
+
+
+class RollingExtreme:
+    """單調佇列維護視窗內最高 (或最低) 值，攤銷 O(1)"""
+
+    def __init__(self, window, mode="max"):
+        self.window = window
+        self.better = (lambda a, b: a >= b) if mode == "max" else (lambda a, b: a <= b)
+        self.items = deque()  # (index, value)，value 單調
+        self.count = 0
+
+    def push(self, value):
+        while self.items and self.better(value, self.items[-1][1]):
+            self.items.pop()
+        self.items.append((self.count, value))
+        self.count += 1
+        while self.items[0][0] <= self.count - 1 - self.window:
+            self.items.popleft()
+
+    @property
+    def value(self):
+        if not self.items:
+            return math.nan
+        return self.items[0][1]
+
+    def peek(self, value):
+        """加入 value 後的極值 (不改變狀態)"""
+        if not self.items:
+            return value
+        # 下一筆加入後，最舊的一筆可能滑出視窗
+        head_idx, head_val = self.items[0]
+        if head_idx <= self.count - self.window:
+            cur = self.items[1][1] if len(self.items) > 1 else value
+        else:
+            cur = head_val
+        return value if self.better(value, cur) else cur
+
+
+class SymbolIndicators:
+    """單一標的的增量指標狀態 (日 K)"""
+
+    def __init__(self, ma_windows=(20, 60), atr_window=14, hl_window=20, max_history=400):
+        self.mas = {w: RollingMean(w) for w in ma_windows}
+        self.atr = RollingMean(atr_window)
+        self.highs = RollingExtreme(hl_window, "max")
+        self.lows = RollingExtreme(hl_window, "min")
+        self.prev_close = None
+        self.last_ts = None          # 最後一根「已完成」K 棒的時間
+        self.pending = None          # 當日尚未收盤的 K 棒 (ts, o, h, l, c, v)
+        self.history = deque(maxlen=max_history)
+        # 監控用區間最高價 (自基準日起)
+        self.anchor = None
+        self.period_high = 0.0
+        self.last_price = None
+        self.quote = None            # 最後一筆帶快照時間的報價 (price, ts)
+        self.checked = None          # 已向券商確認沒有更新 K 棒的收盤日 (例如國定假日)
+
+    def _true_range(self, high, low):
+        if self.prev_close is None:
+            return high - low
+        return max(high - low, abs(high - self.prev_close), abs(low - self.prev_close))
+
+    def commit_bar(self, ts, o, h, l, c, v):
+        """餵入一根已完成的 K 棒"""
+        if self.last_ts is not None and ts <= self.last_ts:
+            return
+        self.atr.push(self._true_range(h, l))
+        for ma in self.mas.values():
+            ma.push(c)
+        self.highs.push(h)
+        self.lows.push(l)
+        self.prev_close = c
+        self.last_ts = ts
+        if self.pending is not None and self.pending[0] <= ts:
+            self.pending = None
+
+        row = {"ts": ts, "Open": o, "High": h, "Low": l, "Close": c, "Volume": v}
+        for w, ma in self.mas.items():
+            row[f"MA{w}"] = ma.value
+        row["ATR"] = self.atr.value
+        self.history.append(row)
+
+    def set_pending(self, ts, o, h, l, c, v):
+        """更新當日未完成 K 棒"""
+        if self.last_ts is not None and ts <= self.last_ts:
+            return
+        self.pending = (ts, o, h, l, c, v)
+
+    def on_price(self, price, ts=None):
+        """
+        盤中即時價：更新區間最高價與當日暫定 K 棒。
+        ts 為快照時間 (epoch ns)；只有盤中且為今日的快照才會開出當日暫定 K 棒，
+        避免開盤前 / 假日以前一日收盤價產生假的 K 棒。
+        """
+        self.last_price = price
+        if ts is not None:
+            self.quote = (price, ts)
+        if price > self.period_high:
+            self.period_high = price
+        if self.pending is None and self.last_ts is not None and ts is not None \
+                and market_phase() == "session":
+            # 日 K 已預抓至前一交易日：以即時價格開出當日暫定 K 棒 (開盤價以第一筆價格近似)
+            today = pd.Timestamp.now().normalize()
+            if pd.Timestamp(ts).normalize() == today and today > self.last_ts:
+                self.pending = (today, price, price, price, price, 0.0)
+        if self.pending is not None:
+            ts, o, h, l, _, v = self.pending
+            self.pending = (ts, o, max(h, price), min(l, price), price, v)
+
+    def _pending_row(self):
+        ts, o, h, l, c, v = self.pending
+        row = {"ts": ts, "Open": o, "High": h, "Low": l, "Close": c, "Volume": v}
+        for w, ma in self.mas.items():
+            row[f"MA{w}"] = ma.peek(c)
+        if self.prev_close is None:
+            tr = h - l
+        else:
+            tr = max(h - l, abs(h - self.prev_close), abs(l - self.prev_close))
+        row["ATR"] = self.atr.peek(tr)
+        return row
+
+    def live(self):
+        """目前 (含盤中暫定值) 的指標數值"""
+        price = self.last_price
+        if price is None and self.pending is not None:
+            price = self.pending[4]
+        if price is None:
+            price = self.prev_close
+        values = {"price": price, "period_high": self.period_high}
+        if self.pending is not None:
+            row = self._pending_row()
+            values.update({k: row[k] for k in row if k.startswith("MA") or k == "ATR"})
+            values["high_n"] = self.highs.peek(row["High"])
+            values["low_n"] = self.lows.peek(row["Low"])
+        else:
+            values.update({f"MA{w}": ma.value for w, ma in self.mas.items()})
+            values["ATR"] = self.atr.value
+            values["high_n"] = self.highs.value
+            values["low_n"] = self.lows.value
+        return values
+
+
+class IndicatorEngine:
+    """
+    增量指標引擎：依標的維護 MA / ATR / 區間高低點。
+    由已完成的 K 棒與盤中即時價驅動，圖表與監控執行緒共用同一份狀態。
+    """
+
+    def __init__(self, ma_windows=(20, 60), atr_window=14, hl_window=20, max_history=400):
+        self.params = dict(ma_windows=ma_windows, atr_window=atr_window,
+                           hl_window=hl_window, max_history=max_history)
+        self.symbols = {}
+        self.lock = threading.RLock()
+
+    def _get(self, code):
+        state = self.symbols.get(code)
+        if state is None:
+            state = SymbolIndicators(**self.params)
+            self.symbols[code] = state
+        return state
+
+    def has_bars(self, code):
+        with self.lock:
+            state = self.symbols.get(code)
+            return state is not None and state.last_ts is not None
+
+    def last_bar_date(self, code):
+        """最後一根已完成 K 棒的日期 (供呼叫端只抓取新資料)"""
+        with self.lock:
+            state = self.symbols.get(code)
+            if state is None or state.last_ts is None:
+                return None
+            return state.last_ts
+
+    def mark_checked(self, code, session_date):
+        """記錄已查詢至 session_date 且券商沒有更新的 K 棒 (假日不必每次重抓)"""
+        with self.lock:
+            state = self._get(code)
+            session_date = pd.Timestamp(session_date)
+            if state.checked is None or session_date > state.checked:
+                state.checked = session_date
+
+    def checked_date(self, code):
+        with self.lock:
+            state = self.symbols.get(code)
+            return state.checked if state is not None else None
+
+    def ingest_bars(self, code, df_daily, today=None):
+        """
+        餵入日 K (index 為日期)。只處理比最後一根更新的 K 棒；
+        今日的 K 棒視為未完成，僅作為暫定值保存。
+        """
+        if df_daily is None or df_daily.empty:
+            return
+        today = pd.Timestamp(today or datetime.now().date())
+        with self.lock:
+            state = self._get(code)
+            if state.last_ts is not None:
+                df_daily = df_daily[df_daily.index > state.last_ts]
+            for ts, o, h, l, c, v in zip(df_daily.index, df_daily["Open"], df_daily["High"],
+                                         df_daily["Low"], df_daily["Close"], df_daily["Volume"]):
+                ts = pd.Timestamp(ts).normalize()
+                bar = (ts, float(o), float(h), float(l), float(c), float(v))
+                if ts >= today:
+                    state.set_pending(*bar)
+                else:
+                    state.commit_bar(*bar)
+
+    def seed_high(self, code, high, anchor):
+        """以歷史資料設定區間最高價 (基準日改變時重設)"""
+        with self.lock:
+            state = self._get(code)
+            if state.anchor != anchor:
+                state.anchor = anchor
+                state.period_high = 0.0
+            if high > state.period_high:
+                state.period_high = float(high)
+
+    def period_high(self, code, anchor):
+        """取得區間最高價；尚未以此基準日初始化時回傳 None"""
+        with self.lock:
+            state = self.symbols.get(code)
+            if state is None or state.anchor != anchor or state.period_high <= 0:
+                return None
+            return state.period_high
+
+    def on_price(self, code, price, ts=None):
+        with self.lock:
+            self._get(code).on_price(float(price), ts)
+
+    def last_quote(self, code):
+        """最後一筆帶快照時間的報價 (price, ts epoch ns)；沒有時回傳 (None, None)"""
+        with self.lock:
+            state = self.symbols.get(code)
+            if state is None or state.quote is None:
+                return None, None
+            return state.quote
+
+    def live(self, code):
+        with self.lock:
+            state = self.symbols.get(code)
+            return state.live() if state is not None else {}
+
+    def frame(self, code):
+        """已完成 K 棒 + 當日暫定 K 棒的指標表 (圖表用)"""
+        with self.lock:
+            state = self.symbols.get(code)
+            if state is None:
+                return pd.DataFrame()
+            rows = list(state.history)
+            if state.pending is not None:
+                rows.append(state._pending_row())
+        if not rows:
+            return pd.DataFrame()
+        return pd.DataFrame(rows).set_index("ts")
@@ -1,13 +1,20 @@
 
-import pandas as pd
+import numpy as np
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from .api_service import place_sell_order
-import yfinance as yf # Fallback source
+from .api_service import place_sell_order, get_daily_bars
+from .data_source import market_data, backoff_delay
+from .exit_rules import compile_rules, drop_unresolved_accounts
+from .indicators import IndicatorEngine
+
+def book_code(key):
+    """targets key -> 股票代碼 (key 可為代碼或 (帳號, 代碼))"""
+    return key[-1] if isinstance(key, tuple) else key
 
 def monitor_logic(api, log_list, latest_prices, max_prices, stop_event,
-                  trailing_stop_pct, order_type_str, targets, start_date_str):
+                  trailing_stop_pct, order_type_str, targets, start_date_str,
+                  indicators=None, recorder=None, accounts=None, pnl=None):
     """
     背景監控邏輯 (執行緒函式)
     args:
@@ -16,7 +23,17 @@ def monitor_logic(api, log_list, latest_prices, max_prices, stop_event,
         latest_prices: Shared dict for real-time prices (st.session_state.latest_prices)
         max_prices: Shared dict for max prices (st.session_state.max_prices)
         stop_event: threading.Event to control loop
+        trailing_stop_pct: 全域移動停損 %，未個別設定的標的使用此值
+        targets: code -> {'cost', 'qty', 'rules'}，rules 見 modules.exit_rules。
+                 多帳號時 key 為 (account_id, code)：行情每檔只抓一次，再分送給持有的各帳號
         ...
+        indicators: IndicatorEngine (optional). 已有同基準日的區間最高價時不重抓歷史 K 線，
+                    盤中價格亦會回寫至引擎供 UI / 圖表使用
+        recorder: SnapshotRecorder (optional). 每輪收到的快照交由背景執行緒寫入紀錄檔
+        accounts: account_id -> account. 觸發時依 targets key 的帳號下單；
+                  key 為 (帳號, 代碼) 而帳號不在其中的部位不監控
+        pnl: PnLLedger (optional). 每個報價即時更新持有部位的未實現損益
+
     """
     
     def log(message):
@@ -27,7 +44,8 @@ def monitor_logic(api, log_list, latest_prices, max_prices, stop_event,
             log_list.pop()
 
     log("=== 監控服務已啟動 ===")
-    
+    drop_unresolved_accounts(targets, accounts, log)
+
     if not targets:
         log("無監控標的，監控服務停止")
         stop_event.set()
@@ -35,132 +53,133 @@ def monitor_logic(api, log_list, latest_prices, max_prices, stop_event,
 
     # --- 1. 預先抓取歷史最高價 (從指定交易日開始) ---
     log(f"正在抓取歷史資料 (起始日: {start_date_str})...")
+    md = market_data(api)
+    start_dt = datetime.strptime(start_date_str, "%Y-%m-%d")
     
-    for code, info in targets.items():
-        try:
-            contract = api.Contracts.Stocks.get(code)
-            if not contract:
-                log(f"[{code}] 找不到合約資訊，將以現價為基準")
+    symbols = list(dict.fromkeys(book_code(key) for key in targets))
+    for code in symbols:
+        if indicators is not None:
+            cached_high = indicators.period_high(code, start_date_str)
+            if cached_high is not None:
+                max_prices[code] = cached_high
+                log(f"[{code}] 使用指標引擎快取的區間最高價: {cached_high}")
                 continue
-                
-            # 抓取 K 線 (日 K)
-            today_str = datetime.now().strftime("%Y-%m-%d")
-            log(f"[{code}] 請求 K 線範圍: {start_date_str} ~ {today_str} (Source: Shioaji)")
-            
-            historical_high = 0.0
-            has_data = False
-            
-            # --- Tier 1: Shioaji API ---
-            try:
-                kbars = api.kbars(contract, start=start_date_str, end=today_str, timeout=10000)
-                df_k = pd.DataFrame({**kbars})
-                if not df_k.empty:
-                    historical_high = float(df_k['High'].max())
-                    log(f"[{code}] Shioaji 歷史最高價: {historical_high}")
-                    has_data = True
-                else:
-                    log(f"[{code}] Shioaji 查無資料 (Empty)")
-            except Exception as e:
-                log(f"[{code}] Shioaji API 錯誤: {e}")
-
-            # --- Tier 2: yfinance Fallback ---
-            if not has_data:
-                try:
-                    yf_code = f"{code}.TW"
-                    log(f"[{code}] 嘗試使用 yfinance 抓取 ({yf_code})...")
-                    yf_df = yf.download(yf_code, start=start_date_str, end=today_str, progress=False)
-                    
-                    if not yf_df.empty:
-                        # yfinance High column might be multi-level if not flattened, but usually simple download is fine or check structure
-                        # yfinance 0.2.x returns MultiIndex columns sometimes. Safe max.
-                        if 'High' in yf_df.columns:
-                            h_col = yf_df['High']
-                            historical_high = float(h_col.max()) # Works for Series or single-col DF
-                            log(f"[{code}] yfinance 歷史最高價: {historical_high}")
-                            has_data = True
-                        else:
-                            log(f"[{code}] yfinance 資料格式不符 (缺少 High)")
-                    else:
-                        log(f"[{code}] yfinance 亦無資料")
-                except Exception as e:
-                    log(f"[{code}] yfinance 失敗: {e}")
-
-            # --- Final Decision ---
-            if has_data and historical_high > 0:
-                 max_prices[code] = historical_high
-            else:
-                 log(f"[{code}] ⚠ 查無任何歷史 K 線，將以稍後抓取的現價為基準")
-                 
-        except Exception as e:
-            log(f"[{code}] 抓取歷史資料失敗: {e}")
+        # 依來源健康度自動切換 / hedge (Shioaji -> yfinance)
+        historical_high, source = md.call("period_high", code, start_dt, datetime.now())
+        if historical_high is not None and historical_high > 0:
+            log(f"[{code}] {source} 歷史最高價: {historical_high}")
+            max_prices[code] = historical_high
+            if indicators is not None:
+                indicators.seed_high(code, historical_high, start_date_str)
+        else:
+            log(f"[{code}] ⚠ 查無任何歷史 K 線 ({source})，將以稍後抓取的現價為基準")
+
+    log(f"監控標的共 {len(symbols)} 檔 ({len(targets)} 個部位): {symbols}")
+
+    # --- 2. 編譯出場規則 (所有標的一次向量化評估) ---
+    book = compile_rules(targets, trailing_stop_pct)
+    if book.needs_indicators:
+        if indicators is None:
+            indicators = IndicatorEngine()
+        end_dt = datetime.now()
+        for code in book.index:
+            if not indicators.has_bars(code):
+                log(f"[{code}] 載入日 K 以計算 ATR / 均線...")
+                indicators.ingest_bars(code, get_daily_bars(api, code, end_dt - timedelta(days=250), end_dt))
+        book.update_indicators(indicators)
+    indicator_refreshed = time.time()
 
-    log(f"監控標的共 {len(targets)} 檔: {list(targets.keys())}")
+    prices = np.zeros(len(book))
+    highs = np.array([max_prices.get(code, 0.0) for code in book.codes])
+    contracts_list = None
+    errors = 0  # 連續錯誤次數 (退避用)
 
     while not stop_event.is_set():
         try:
-            # 2. 抓取 Snapshot
-            codes = list(targets.keys())
-            if not codes:
+            # 3. 抓取 Snapshot
+            if not book.active.any():
                 log("所有標的已處理完畢，停止監控")
                 stop_event.set()
                 break
-            
-            contracts_list = []
-            for c in codes:
-                contract = api.Contracts.Stocks.get(c)
-                if contract:
-                    contracts_list.append(contract)
-            
+
+            if contracts_list is None:
+                contracts_list = []
+                for c in dict.fromkeys(book_code(key) for key in targets):
+                    contract = api.Contracts.Stocks.get(c)
+                    if contract:
+                        contracts_list.append(contract)
+
             if not contracts_list:
                 log("無法取得監控標的之合約資訊，稍後重試...")
-                time.sleep(5)
+                contracts_list = None
+                stop_event.wait(backoff_delay(errors, base=2.0))
+                errors += 1
                 continue
 
-            snapshots = api.snapshots(contracts_list)
-            
+            snapshots, source = md.call("quotes", contracts_list)
+            if snapshots is None:
+                raise RuntimeError(f"取得報價失敗: {source}")
+            if recorder is not None:
+                recorder.record(snapshots)
+
+            # --- A. 更新現價與最高價 ---
             for snap in snapshots:
                 code = snap.code
                 current_price = snap.close
-                
-                if current_price == 0: continue 
-                
-                qty = targets[code]['qty']
-                
-                # --- A. 更新最高價 ---
+                if current_price == 0: continue
+
                 # 更新即時價格到 Global State 供 UI 讀取
                 latest_prices[code] = current_price
 
                 if code not in max_prices:
                     max_prices[code] = current_price
                     log(f"[{code}] 監控開始，初始價格: {current_price}")
-                else:
-                    if current_price > max_prices[code]:
-                         max_prices[code] = current_price
-                
-                max_price = max_prices[code]
-                
-                # --- B. 計算邏輯 ---
-                exit_price = max_price * (1 - trailing_stop_pct / 100)
-                
-                triggered = False
-                trigger_reason = ""
-                
-                if current_price <= exit_price:
-                    triggered = True
-                    trigger_reason = f"觸發移動停損/停利 (現價 {current_price} <= 防守價 {exit_price:.2f}, 波段最高 {max_price})"
-                
-                # --- C. 觸發下單 ---
-                if triggered:
-                    place_sell_order(api, code, qty, order_type_str, trigger_reason)
-                    # 移除監控
-                    del targets[code]
-                    if code in max_prices:
-                        del max_prices[code]
-            
-            time.sleep(3) 
-            
+                elif current_price > max_prices[code]:
+                    max_prices[code] = current_price
+
+                if indicators is not None:
+                    indicators.on_price(code, current_price, getattr(snap, 'ts', None))
+                if pnl is not None:
+                    pnl.on_price(code, current_price)
+
+                for i in book.index.get(code, ()):
+                    prices[i] = current_price
+                    highs[i] = max_prices[code]
+
+            if book.needs_indicators and time.time() - indicator_refreshed > 60:
+                book.update_indicators(indicators)
+                indicator_refreshed = time.time()
+
+            # --- B. 批次評估所有出場規則 ---
+            rows, rules, levels = book.evaluate(prices, highs)
+
+            # --- C. 觸發下單 ---
+            for row, rule, level in zip(rows, rules, levels):
+                key, code = book.keys[row], book.codes[row]
+                account = accounts[key[0]] if isinstance(key, tuple) else None
+                reason = book.describe(row, rule, prices[row], highs[row], level)
+                place_sell_order(api, code, targets[key]['qty'], order_type_str, reason,
+                                 account=account, log_fn=log)
+                # 移除監控 (其他帳號仍持有時保留該檔的最高價與報價)
+                book.active[row] = False
+                del targets[key]
+                if not book.active[book.index[code]].any():
+                    max_prices.pop(code, None)
+                    contracts_list = None
+
+            if pnl is not None:
+                pnl.save(min_interval=30)
+            errors = 0
+            time.sleep(3)
+
         except Exception as e:
             log(f"監控迴圈發生錯誤: {e}")
-            time.sleep(5) 
+            # 指數退避 + jitter，避免券商異常時固定間隔重試
+            stop_event.wait(3 + backoff_delay(errors, base=2.0))
+            errors += 1
 
+    if recorder is not None:
+        recorder.flush()
+    if pnl is not None:
+        pnl.save()
     log("=== 監控服務已停止 ===")
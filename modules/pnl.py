@@ -0,0 +1,277 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+
+DEFAULT_PATH = os.path.join("data", "pnl_ledger.json")
+
+# 台股費率
+FEE_RATE = 0.001425     # 手續費 (買賣皆收)
+FEE_MIN = 20            # 手續費最低 20 元
+TAX_RATE_STOCK = 0.003  # 證交稅 (賣出)
+TAX_RATE_ETF = 0.001    # ETF 證交稅 (賣出)
+
+MAX_FILLS = 1000        # 保留的成交紀錄筆數
+MAX_SEEN = 5000         # 保留的已處理成交編號 (依收到順序)
+
+
+def trade_fee(amount, discount=1.0):
+    """手續費 (含券商折扣，最低 20 元)"""
+    if amount <= 0:
+        return 0.0
+    return float(max(FEE_MIN, int(amount * FEE_RATE * discount)))
+
+
+def trade_tax(code, amount):
+    """賣出證交稅；ETF (代碼 00 開頭) 為 0.1%"""
+    rate = TAX_RATE_ETF if code.startswith("00") else TAX_RATE_STOCK
+    return float(int(amount * rate))
+
+
+class PnLLedger:
+    """
+    增量損益帳本。
+    每筆成交 (on_fill) 與每個報價 (on_price) 都只更新受影響的部位與總計，O(1)；
+    未實現損益已扣除預估賣出手續費與證交稅。
+    狀態存於本機 JSON：成交時只標記 dirty，由呼叫端定期 save(min_interval) 寫入 (rerun / 監控迴圈)。
+    """
+
+    def __init__(self, path=DEFAULT_PATH, fee_discount=1.0):
+        self.path = path
+        self.fee_discount = fee_discount
+        self.lock = threading.RLock()
+        self.positions = {}   # (account_id, code) -> {'qty', 'cost', 'price', 'unrealized'}
+        self.by_code = {}     # code -> set of keys
+        self.realized = 0.0
+        self.unrealized = 0.0
+        self.fees = 0.0
+        self.taxes = 0.0
+        self.fills = deque(maxlen=MAX_FILLS)   # 成交紀錄
+        self.seen = OrderedDict()              # 已處理的成交編號 (避免重複回報)，依收到順序
+        self.dirty = False
+        self.saved_at = 0.0
+        self.load()
+
+    # --- 部位計算 ---
+    def _unrealized(self, code, qty, cost, price):
+        if qty <= 0 or price <= 0:
+            return 0.0
+        value = qty * price
+        return value - trade_fee(value, self.fee_discount) - trade_tax(code, value) - cost
+
+    def _set(self, key, qty, cost, price):
+        """更新單一部位並以差額調整總計"""
+        code = key[1]
+        old = self.positions.get(key)
+        old_unrealized = old["unrealized"] if old else 0.0
+        if qty <= 0:
+            self.positions.pop(key, None)
+            self.by_code.get(code, set()).discard(key)
+            new_unrealized = 0.0
+        else:
+            new_unrealized = self._unrealized(code, qty, cost, price)
+            self.positions[key] = {"qty": qty, "cost": cost, "price": price, "unrealized": new_unrealized}
+            self.by_code.setdefault(code, set()).add(key)
+        self.unrealized += new_unrealized - old_unrealized
+
+    def on_price(self, code, price):
+        """報價更新：只重算持有此代碼的部位"""
+        with self.lock:
+            for key in self.by_code.get(code, ()):
+                pos = self.positions[key]
+                if pos["price"] != price:
+                    self._set(key, pos["qty"], pos["cost"], price)
+
+    def on_fill(self, account_id, code, action, price, qty, fill_id=None, ts=None):
+        """
+        成交回報。買進增加成本 (含手續費)；賣出以平均成本計算已實現損益 (扣手續費與證交稅)。
+        qty 以股為單位。
+        """
+        with self.lock:
+            if fill_id is not None:
+                if fill_id in self.seen:
+                    return
+                self.seen[fill_id] = None
+                if len(self.seen) > MAX_SEEN:
+                    self.seen.popitem(last=False)
+            key = (account_id, code)
+            pos = self.positions.get(key, {"qty": 0, "cost": 0.0, "price": price})
+            amount = price * qty
+            fee = trade_fee(amount, self.fee_discount)
+            tax = 0.0
+            realized = 0.0
+
+            if action == "Buy":
+                new_qty, new_cost = pos["qty"] + qty, pos["cost"] + amount + fee
+            else:
+                tax = trade_tax(code, amount)
+                sell_qty = min(qty, pos["qty"]) if pos["qty"] > 0 else qty
+                avg_cost = pos["cost"] / pos["qty"] if pos["qty"] > 0 else price
+                realized = amount - fee - tax - avg_cost * sell_qty
+                new_qty = pos["qty"] - sell_qty
+                new_cost = pos["cost"] - avg_cost * sell_qty if new_qty > 0 else 0.0
+
+            self.realized += realized
+            self.fees += fee
+            self.taxes += tax
+            self._set(key, new_qty, new_cost, price)
+            self.fills.append({
+                "ts": ts or datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "account": account_id, "code": code, "action": action,
+                "price": price, "qty": qty, "fee": fee, "tax": tax, "realized": realized,
+            })
+            self.dirty = True
+
+    def sync_position(self, account_id, code, qty, avg_price, price):
+        """
+        以券商庫存校正部位 (不產生已實現損益)。
+        股數與帳本一致時只更新報價，保留帳本內含手續費的成本。
+        """
+        with self.lock:
+            key = (account_id, code)
+            pos = self.positions.get(key)
+            if pos is not None and pos["qty"] == qty:
+                if pos["price"] != price:
+                    self._set(key, qty, pos["cost"], price)
+                return
+            cost = qty * avg_price + trade_fee(qty * avg_price, self.fee_discount)
+            self._set(key, qty, cost, price)
+            self.dirty = True
+
+    def drop_missing(self, account_ids, keys):
+        """移除券商庫存中已不存在的部位 (僅限指定帳號)"""
+        with self.lock:
+            for key in [k for k in self.positions if k[0] in account_ids and k not in keys]:
+                self._set(key, 0, 0.0, 0.0)
+                self.dirty = True
+
+    def position_unrealized(self, account_id, code):
+        pos = self.positions.get((account_id, code))
+        return pos["unrealized"] if pos else 0.0
+
+    def totals(self):
+        with self.lock:
+            return {"realized": self.realized, "unrealized": self.unrealized,
+                    "fees": self.fees, "taxes": self.taxes}
+
+    # --- 持久化 ---
+    def save(self, min_interval=0.0):
+        """寫入本機 JSON (min_interval 秒內已存過則略過)"""
+        with self.lock:
+            if not self.dirty or time.time() - self.saved_at < min_interval:
+                return
+            state = {
+                "positions": {f"{a}|{c}": p for (a, c), p in self.positions.items()},
+                "realized": self.realized, "fees": self.fees, "taxes": self.taxes,
+                "fills": list(self.fills), "seen": list(self.seen),
+            }
+            self.dirty = False
+            self.saved_at = time.time()
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+        except OSError:
+            self.dirty = True
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            for k, p in state.get("positions", {}).items():
+                account_id, code = k.split("|", 1)
+                self._set((account_id, code), p["qty"], p["cost"], p["price"])
+            self.realized = state.get("realized", 0.0)
+            self.fees = state.get("fees", 0.0)
+            self.taxes = state.get("taxes", 0.0)
+            self.fills = deque(state.get("fills", []), maxlen=MAX_FILLS)
+            self.seen = OrderedDict.fromkeys(state.get("seen", [])[-MAX_SEEN:])
+
+
+def parse_deal(msg):
+    """
+    成交回報 (StockDeal) -> (account_id, code, action, price, qty, fill_id)。
+    成交回報的 account_id 位於最上層；委託回報才有巢狀的 account，作為備援。
+    整股 (Common) 的 quantity 單位為張，轉為股數。
+    """
+    lot = str(msg.get("order_lot", "Common"))
+    qty = int(msg["quantity"]) * (1000 if lot.endswith("Common") else 1)
+    action = str(msg["action"]).split(".")[-1]
+    account_id = msg.get("account_id") or (msg.get("account") or {}).get("account_id", "")
+    fill_id = f"{msg.get('trade_id', '')}-{msg.get('seqno', '')}-{msg.get('exchange_seq', '')}"
+    return account_id, msg["code"], action, float(msg["price"]), qty, fill_id
+
+
+def make_order_callback(ledger, log_fn=None):
+    """建立 Shioaji 委託/成交回報 callback，將證券成交送入帳本"""
+    from shioaji import constant
+
+    # 新版為 StockDeal，舊版為 TFTDeal
+    deal_states = {getattr(constant.OrderState, name) for name in ("StockDeal", "TFTDeal")
+                   if hasattr(constant.OrderState, name)}
+
+    def callback(stat, msg):
+        try:
+            if stat not in deal_states:
+                return
+            account_id, code, action, price, qty, fill_id = parse_deal(msg)
+            ledger.on_fill(account_id, code, action, price, qty, fill_id=fill_id)
+            if log_fn:
+                log_fn(f"【成交回報】{account_id} {msg['code']} {action} {qty} 股 @ {msg['price']}")
+        except Exception as e:
+            if log_fn:
+                log_fn(f"成交回報處理失敗: {e}")
+
+    return callback
+
+
+def check():
+    """
+    以 Shioaji StockDeal 格式的成交回報檢查帳本：賣出須沖銷同帳號部位，
+    已實現損益 = 成交金額 - 手續費 - 證交稅 - 平均成本，且重複回報不重複入帳。
+    """
+    deal = {
+        "trade_id": "12ab3456", "seqno": "123456", "ordno": "IM0000", "exchange_seq": "000001",
+        "broker_id": "9A95", "account_id": "1234567", "action": "Action.Sell", "code": "2330",
+        "order_cond": "StockOrderCond.Cash", "order_lot": "StockOrderLot.Common",
+        "price": 600, "quantity": 1, "web_id": "137", "custom_field": "", "ts": 1583828972,
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        ledger = PnLLedger(path=os.path.join(tmp, "ledger.json"))
+        ledger.sync_position("1234567", "2330", 1000, 500.0, 600.0)
+        avg_cost = ledger.positions[("1234567", "2330")]["cost"]
+        account_id, code, action, price, qty, fill_id = parse_deal(deal)
+        ledger.on_fill(account_id, code, action, price, qty, fill_id=fill_id)
+        ledger.on_fill(account_id, code, action, price, qty, fill_id=fill_id)
+        amount = 600.0 * 1000
+        expected = amount - trade_fee(amount) - trade_tax("2330", amount) - avg_cost
+        ledger.save()
+        reloaded = PnLLedger(path=ledger.path)
+
+    checks = {
+        "成交回報帳號取自最上層 account_id": account_id == "1234567",
+        "整股張數轉為股數": qty == 1000,
+        "賣出沖銷同帳號部位": ("1234567", "2330") not in ledger.positions and "" not in
+                         {key[0] for key in ledger.positions},
+        "已實現損益 = 成交金額 - 手續費 - 證交稅 - 平均成本": abs(ledger.realized - expected) < 1e-6,
+        "重複回報不重複入帳": len(ledger.fills) == 1,
+        "存檔後重新載入結果一致": reloaded.realized == ledger.realized and fill_id in reloaded.seen,
+    }
+    for name, passed in checks.items():
+        print(f"{'PASS' if passed else 'FAIL'}  {name}")
+    return 0 if all(checks.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(check())
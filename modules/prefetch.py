@@ -0,0 +1,244 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta, time as dtime
+
+import pandas as pd
+
+from .data_source import market_data
+
+SESSION_OPEN = dtime(9, 0)
+SESSION_CLOSE = dtime(13, 30)
+SESSION_SETTLED = dtime(14, 0)  # 13:30 收盤，保留緩衝待當日 K 棒完整
+
+# 券商行情查詢額度 (Shioaji：每 5 秒 50 次，與快照查詢共用)
+QUOTA_WINDOW = 5.0
+# 歷史資料每個視窗可使用的次數：盤中只用一小部分，其餘保留給即時報價與下單
+HISTORY_QUOTA = {"pre_open": 40, "session": 5, "post_close": 40}
+MAX_ATTEMPTS = 3  # 每檔每個時段最多嘗試次數
+
+BULK, GAP = 0, 1  # 優先序 (數字小者先)：開盤前 / 收盤後整批預抓、盤中補缺
+
+
+def market_phase(now=None):
+    """pre_open / session / post_close (週末視為 post_close)"""
+    now = now or datetime.now()
+    if now.weekday() >= 5:
+        return "post_close"
+    if now.time() < SESSION_OPEN:
+        return "pre_open"
+    if now.time() < SESSION_SETTLED:
+        return "session"
+    return "post_close"
+
+
+def last_session_date(now=None):
+    """最近一個已收盤的交易日 (以週一至週五估算，不含國定假日；假日由 bars_current 的查詢紀錄處理)"""
+    now = now or datetime.now()
+    day = pd.Timestamp(now.date())
+    if now.weekday() < 5 and now.time() >= SESSION_SETTLED:
+        return day
+    day -= pd.Timedelta(days=1)
+    while day.weekday() >= 5:
+        day -= pd.Timedelta(days=1)
+    return day
+
+
+def bars_current(indicators, code, now=None):
+    """
+    指標引擎內的日 K 是否已涵蓋最近一個收盤日 (是則不需再向券商查詢)。
+    估算的收盤日若是國定假日，券商不會有該日 K 棒；已查詢過且無更新者同樣視為最新。
+    """
+    last = indicators.last_bar_date(code)
+    if last is None:
+        return False
+    expected = last_session_date(now)
+    checked = indicators.checked_date(code)
+    return last >= expected or (checked is not None and checked >= expected)
+
+
+class RateBudget:
+    """滑動視窗限流：window 秒內最多 limit 次"""
+
+    def __init__(self, window=QUOTA_WINDOW):
+        self.window = window
+        self.calls = deque()
+
+    def acquire(self, limit, stop_event):
+        while not stop_event.is_set():
+            now = time.monotonic()
+            while self.calls and now - self.calls[0] >= self.window:
+                self.calls.popleft()
+            if len(self.calls) < limit:
+                self.calls.append(now)
+                return True
+            stop_event.wait(self.window - (now - self.calls[0]))
+        return False
+
+
+class HistoryPrefetcher:
+    """
+    依交易時段排程的歷史資料預抓。
+    開盤前 / 收盤後對所有持有與觀察中的代碼整批更新日 K 與區間最高價，寫入 IndicatorEngine，
+    讓監控、庫存表與圖表開盤時直接使用快取；盤中只補缺 (每檔每日一次) 且以低優先序、少量額度進行，
+    其餘查詢額度保留給即時報價與下單。持有部位優先於觀察清單。
+    """
+
+    def __init__(self, api, indicators, anchor=None):
+        self.api = api
+        self.indicators = indicators
+        self.anchor = anchor        # 區間最高價基準日 (YYYY-MM-DD)
+        self.held = []
+        self.watched = []
+        self.heap = []              # (priority, rank, seq, code)
+        self.queued = {}            # code -> 佇列中的最佳優先序
+        self.attempts = {}          # code -> ((date, phase), 次數)
+        self.seq = itertools.count()
+        self.budget = RateBudget()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.phase = market_phase()
+        self.stats = {"預抓": 0, "盤中補缺": 0, "失敗": 0}
+        self.last_error = ""
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True, name="history-prefetch")
+        self.thread.start()
+
+    def stop(self, timeout=2.0):
+        self.stop_event.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def set_symbols(self, held, watched=(), anchor=None):
+        """更新要維護的代碼 (每次 rerun 呼叫；有變動才喚醒排程)"""
+        held = list(dict.fromkeys(held))
+        held_set = set(held)
+        watched = [c for c in dict.fromkeys(watched) if c not in held_set]
+        with self.lock:
+            changed = (held, watched, anchor) != (self.held, self.watched, self.anchor)
+            if anchor != self.anchor:
+                self.attempts.clear()
+            self.held, self.watched, self.anchor = held, watched, anchor
+        if changed:
+            self.wakeup.set()
+
+    def request(self, codes):
+        """
+        UI 缺資料時要求補齊 (盤中仍為低優先序，但排在已排程的觀察清單之前)。
+        與排程相同受每時段嘗試次數限制，失敗或無資料的代碼不會每次 rerun 重抓。
+        """
+        now = datetime.now()
+        priority = GAP if market_phase(now) == "session" else BULK
+        for code in codes:
+            if not self._exhausted(code, now):
+                self._push(priority, code, rank=0)
+        self.wakeup.set()
+
+    def _exhausted(self, code, now):
+        """此時段的嘗試次數已用完 (盤中每檔每日一次；盤外最多 MAX_ATTEMPTS 次)"""
+        phase = market_phase(now)
+        limit = 1 if phase == "session" else MAX_ATTEMPTS
+        tried_slot, count = self.attempts.get(code, (None, 0))
+        return tried_slot == (now.date(), phase) and count >= limit
+
+    def _push(self, priority, code, rank=None):
+        with self.lock:
+            if self.queued.get(code, priority + 1) <= priority:
+                return
+            self.queued[code] = priority
+            if rank is None:
+                rank = 0 if code in self.held else 1
+            heapq.heappush(self.heap, (priority, rank, next(self.seq), code))
+
+    def _pop(self):
+        with self.lock:
+            while self.heap:
+                priority, _, _, code = heapq.heappop(self.heap)
+                # 已被更高優先序取代的舊項目略過
+                if self.queued.get(code) == priority:
+                    del self.queued[code]
+                    return priority, code
+            return None
+
+    def _needs(self, code, now):
+        """快取是否不足：缺最近收盤日的日 K，或缺此基準日的區間最高價"""
+        if not bars_current(self.indicators, code, now):
+            return True
+        return self.anchor is not None and self.indicators.period_high(code, self.anchor) is None
+
+    def _schedule(self, now):
+        phase = self.phase = market_phase(now)
+        priority = GAP if phase == "session" else BULK
+        with self.lock:
+            symbols = self.held + self.watched
+        for code in symbols:
+            if self._exhausted(code, now):
+                continue
+            if self._needs(code, now):
+                self._push(priority, code)
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            now = datetime.now()
+            self._schedule(now)
+            item = self._pop()
+            if item is None:
+                self.wakeup.wait(60)
+                self.wakeup.clear()
+                continue
+            priority, code = item
+            if not self.budget.acquire(HISTORY_QUOTA[market_phase()], self.stop_event):
+                break
+            self._refresh(code, priority)
+
+    def _refresh(self, code, priority):
+        now = datetime.now()
+        phase = market_phase(now)
+        slot = (now.date(), phase)
+        tried_slot, count = self.attempts.get(code, (None, 0))
+        self.attempts[code] = (slot, count + 1 if tried_slot == slot else 1)
+
+        anchor = self.anchor
+        need_high = anchor is not None and self.indicators.period_high(code, anchor) is None
+        last = self.indicators.last_bar_date(code)
+        start = last.to_pydatetime() if last is not None else now - timedelta(days=250)
+        if need_high:
+            start = min(start, datetime.strptime(anchor, "%Y-%m-%d"))
+
+        df, source = market_data(self.api).call("daily_bars", code, start, now)
+        if df is None:
+            self.stats["失敗"] += 1
+            self.last_error = f"{code}: {source}"
+            return
+
+        # 收盤後當日 K 棒已完整，直接列為已完成
+        today = now + timedelta(days=1) if phase == "post_close" else None
+        self.indicators.ingest_bars(code, df, today=today)
+        self.indicators.mark_checked(code, last_session_date(now))
+        if anchor is not None:
+            highs = df.loc[df.index >= pd.Timestamp(anchor), 'High']
+            if not highs.empty:
+                self.indicators.seed_high(code, round(float(highs.max()), 2), anchor)
+        self.stats["盤中補缺" if priority == GAP else "預抓"] += 1
+
+    def status(self):
+        """排程狀態 (供 UI 顯示)"""
+        with self.lock:
+            queued = len(self.queued)
+            n_symbols = len(self.held) + len(self.watched)
+        phase_names = {"pre_open": "開盤前", "session": "盤中 (只補缺)", "post_close": "收盤後"}
+        return {"時段": phase_names[self.phase], "代碼數": n_symbols, "佇列": queued,
+                **self.stats, "最後錯誤": self.last_error}
@@ -0,0 +1,330 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# 會被計時的券商 API 方法
+BROKER_METHODS = ["list_positions", "list_accounts", "snapshots", "kbars", "place_order", "scanners"]
+
+
+def profiling_from_env():
+    """環境變數 SMARTODER_PROFILE=1 時預設開啟效能分析"""
+    return os.getenv("SMARTODER_PROFILE", "").lower() in ("1", "true", "yes", "on")
+
+
+class RerunProfiler:
+    """
+    Streamlit 每次 rerun 的分段計時器。
+    以 lap() / span() 劃分主要區塊、wrap() 包住模組函式、instrument_api() 包住券商 API，
+    記錄成每次 rerun 的瀑布圖資料並保留最近 history 次；
+    可選擇對最慢的幾次 rerun 保存 cProfile / tracemalloc 結果。
+    """
+
+    def __init__(self, history=50, keep_slowest=3):
+        self.enabled = profiling_from_env()
+        self.deep = False           # 是否同時跑 cProfile / tracemalloc
+        self.history = deque(maxlen=history)
+        self.keep_slowest = keep_slowest
+        self.slowest = []           # [(total, started, cprofile_text, tracemalloc_text)]
+        self.current = None
+        self.stack = []
+        self.lap_open = None        # (name, start) 目前的頂層區段
+        self.thread_id = None
+        self.started = None
+        self.t0 = 0.0
+        self._cprofile = None
+        self._tracing = False
+
+    @property
+    def active(self):
+        return self.current is not None and threading.get_ident() == self.thread_id
+
+    def begin_rerun(self):
+        # 上一次 rerun 被 st.rerun() 中斷而沒有 end_rerun()，先結算
+        if self.current is not None:
+            self.end_rerun(interrupted=True)
+        if self._tracing and not (self.enabled and self.deep):
+            tracemalloc.stop()
+            self._tracing = False
+        if not self.enabled:
+            return
+        self.current = []
+        self.stack = []
+        self.lap_open = None
+        self.thread_id = threading.get_ident()
+        self.started = datetime.now()
+        if self.deep:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing = True
+        self.t0 = time.perf_counter()
+
+    def end_rerun(self, interrupted=False):
+        if self.current is None:
+            return
+        self._close_lap()
+        total = time.perf_counter() - self.t0
+        spans, self.current = self.current, None
+        self.history.append({"started": self.started, "total": total,
+                             "interrupted": interrupted, "spans": spans})
+
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            prof, self._cprofile = self._cprofile, None
+            if len(self.slowest) < self.keep_slowest or total > self.slowest[-1][0]:
+                buf = io.StringIO()
+                pstats.Stats(prof, stream=buf).sort_stats("cumulative").print_stats(25)
+                mem = ""
+                if tracemalloc.is_tracing():
+                    top = tracemalloc.take_snapshot().statistics("lineno")[:15]
+                    mem = "\n".join(str(stat) for stat in top)
+                self.slowest.append((total, self.started, buf.getvalue(), mem))
+                self.slowest.sort(key=lambda item: -item[0])
+                del self.slowest[self.keep_slowest:]
+
+    def _record(self, name, kind, start, duration, depth):
+        self.current.append({
+            "name": name, "kind": kind, "depth": depth,
+            "start": start - self.t0, "duration": duration,
+        })
+
+    def _close_lap(self):
+        if self.lap_open is not None:
+            name, start = self.lap_open
+            self.lap_open = None
+            self._record(name, "section", start, time.perf_counter() - start, 0)
+
+    def lap(self, name):
+        """結束目前的頂層區段並開始新的一段 (不需縮排既有程式碼)"""
+        if not self.active:
+            return
+        self._close_lap()
+        self.lap_open = (name, time.perf_counter())
+
+    @contextmanager
+    def span(self, name, kind="section"):
+        """計時一段程式；只在 rerun 的主執行緒且開啟分析時記錄"""
+        if not self.active:
+            yield
+            return
+        depth = len(self.stack) + (1 if self.lap_open else 0)
+        start = time.perf_counter()
+        self.stack.append(name)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            if self.current is not None:
+                self._record(name, kind, start, time.perf_counter() - start, depth)
+
+    def wrap(self, func, name=None, kind="module"):
+        """包裝函式，每次呼叫記錄為一段"""
+        if getattr(func, "__profiled__", False):
+            return func
+        name = name or f"{func.__module__.split('.')[-1]}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.active:
+                return func(*args, **kwargs)
+            with self.span(name, kind):
+                return func(*args, **kwargs)
+
+        wrapper.__profiled__ = True
+        return wrapper
+
+    def instrument_api(self, api):
+        """在 API 物件上包裝券商呼叫 (只做一次；背景執行緒的呼叫不列入)"""
+        if api is None:
+            return api
+        for method in BROKER_METHODS:
+            func = getattr(api, method, None)
+            if func is None or getattr(func, "__profiled__", False):
+                continue
+            try:
+                setattr(api, method, self.wrap(func, f"broker.{method}", kind="broker"))
+            except (AttributeError, TypeError):
+                pass
+        return api
+
+    def instrument_market_data(self, md):
+        """包裝 MarketData.call，以操作名稱記錄 (實際券商呼叫在其執行緒池中進行)"""
+        call = md.call
+        if getattr(call, "__profiled__", False):
+            return md
+
+        @functools.wraps(call)
+        def wrapper(op, *args):
+            if not self.active:
+                return call(op, *args)
+            with self.span(f"data.{op}", "broker"):
+                return call(op, *args)
+
+        wrapper.__profiled__ = True
+        md.call = wrapper
+        return md
+
+    def last_frame(self):
+        """最近一次完整 rerun 的分段 (瀑布圖用)"""
+        for run in reversed(self.history):
+            if not run["interrupted"]:
+                return pd.DataFrame(run["spans"]), run
+        return pd.DataFrame(), None
+
+    def history_frame(self):
+        return pd.DataFrame([
+            {"時間": r["started"].strftime("%H:%M:%S"), "總耗時(ms)": r["total"] * 1000,
+             "中斷": r["interrupted"], "段數": len(r["spans"])}
+            for r in self.history
+        ])
+
+    def summary_frame(self):
+        """依名稱彙總歷史中各段的平均 / 最大耗時"""
+        rows = [span for run in self.history for span in run["spans"]]
+        if not rows:
+            return pd.DataFrame()
+        df = pd.DataFrame(rows)
+        out = df.groupby(["kind", "name"])["duration"].agg(["count", "mean", "max", "sum"])
+        out[["mean", "max", "sum"]] *= 1000
+        return out.rename(columns={"count": "次數", "mean": "平均(ms)", "max": "最大(ms)", "sum": "累計(ms)"}) \
+                  .sort_values("累計(ms)", ascending=False).reset_index()
+
+
+def process_memory():
+    """
+    行程目前與峰值 RSS (bytes)，無法取得時為 None。
+    有 psutil 時優先使用 (Windows 亦可取得峰值)，否則使用 /proc 與 resource。
+    """
+    rss = peak = None
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        rss, peak = info.rss, getattr(info, "peak_wset", None)
+    except ImportError:
+        pass
+    if peak is None:
+        try:
+            import resource
+            # ru_maxrss 在 macOS 為 bytes，Linux 為 KB
+            scale = 1 if sys.platform == "darwin" else 1024
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+        except ImportError:
+            pass
+    if rss is None and os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm") as f:
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    return rss, peak
+
+
+def data_bytes(obj, depth=4, seen=None):
+    """估算物件內 DataFrame / ndarray 佔用的記憶體 (遞迴走訪 dict、序列與物件屬性)"""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if depth <= 0 or isinstance(obj, (str, bytes, int, float)):
+        return 0
+    if isinstance(obj, dict):
+        children = obj.values()
+    elif isinstance(obj, (list, tuple, set, deque)):
+        children = obj
+    elif hasattr(obj, "__dict__") and type(obj).__module__.startswith("modules."):
+        children = vars(obj).values()
+    else:
+        return 0
+    return sum(data_bytes(child, depth - 1, seen) for child in children)
+
+
+class MemoryTracker:
+    """每次 rerun 取樣行程 RSS 與本 session 持有的資料量，記錄峰值與穩定值 (近期中位數)"""
+
+    def __init__(self, history=60):
+        self.samples = deque(maxlen=history)
+        self.session_peak = 0
+        self.rss_peak = 0
+
+    def sample(self, session_state):
+        rss, peak = process_memory()
+        session = sum(data_bytes(value) for value in session_state.values())
+        self.session_peak = max(self.session_peak, session)
+        self.rss_peak = max(self.rss_peak, peak or rss or 0)
+        self.samples.append((rss or 0, session))
+
+    def report(self):
+        """回傳 (MB)：行程目前 / 峰值 / 穩定值，session 資料目前 / 峰值 / 穩定值"""
+        if not self.samples:
+            return {}
+        mb = 1024 * 1024
+        rss_now, session_now = self.samples[-1]
+        return {
+            "rss": rss_now / mb,
+            "rss_peak": self.rss_peak / mb,
+            "rss_steady": statistics.median(r for r, _ in self.samples) / mb,
+            "session": session_now / mb,
+            "session_peak": self.session_peak / mb,
+            "session_steady": statistics.median(s for _, s in self.samples) / mb,
+        }
+
+
+def render_profiler(profiler):
+    """在頁面上顯示瀑布圖、歷史與最慢 rerun 的 cProfile / tracemalloc"""
+    import streamlit as st
+    import plotly.graph_objects as go
+
+    spans, run = profiler.last_frame()
+    if run is None:
+        st.caption("尚無完整的 rerun 紀錄")
+        return
+
+    st.caption(f"最近一次 rerun：{run['total'] * 1000:.0f} ms ({run['started'].strftime('%H:%M:%S')})")
+    if not spans.empty:
+        spans = spans.sort_values("start")
+        labels = [("　" * d) + n for d, n in zip(spans["depth"], spans["name"])]
+        colors = spans["kind"].map({"section": "steelblue", "module": "seagreen", "broker": "indianred"})
+        fig = go.Figure(go.Bar(
+            y=labels, x=spans["duration"] * 1000, base=spans["start"] * 1000,
+            orientation="h", marker_color=list(colors),
+            hovertemplate="%{y}<br>開始 %{base:.0f} ms，耗時 %{x:.1f} ms<extra></extra>"
+        ))
+        fig.update_layout(
+            xaxis_title="ms", yaxis=dict(autorange="reversed"),
+            height=max(250, 24 * len(spans)), template="plotly_dark",
+            margin=dict(l=10, r=10, t=10, b=10)
+        )
+        st.plotly_chart(fig, use_container_width=True)
+
+    col_h, col_s = st.columns(2)
+    with col_h:
+        st.markdown("**rerun 歷史**")
+        st.line_chart(profiler.history_frame(), x="時間", y="總耗時(ms)", height=200)
+    with col_s:
+        st.markdown("**各段累計**")
+        st.dataframe(profiler.summary_frame(), hide_index=True, height=200)
+
+    for total, started, stats_text, mem_text in profiler.slowest:
+        with st.expander(f"最慢 rerun {total * 1000:.0f} ms @ {started.strftime('%H:%M:%S')}"):
+            st.download_button("下載 cProfile 報告", stats_text,
+                               file_name=f"rerun_{started.strftime('%H%M%S')}.txt",
+                               key=f"prof_{started.timestamp()}")
+            st.text(stats_text[:5000])
+            if mem_text:
+                st.markdown("**tracemalloc 前 15 名**")
+                st.text(mem_text)
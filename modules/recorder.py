@@ -0,0 +1,141 @@
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# 固定寬度的快照紀錄格式 (little-endian)，檔案即為此 dtype 的連續陣列，可直接 memmap
+SNAPSHOT_DTYPE = np.dtype([
+    ("code", "S8"),
+    ("ts", "<i8"),      # epoch ns (Shioaji snapshot.ts)
+    ("close", "<f8"),
+    ("high", "<f8"),
+    ("low", "<f8"),
+    ("volume", "<i8"),  # 累計成交量
+    ("bid", "<f8"),
+    ("ask", "<f8"),
+])
+
+DEFAULT_ROOT = os.path.join("data", "ticks")
+
+
+def snapshot_path(day, root=DEFAULT_ROOT):
+    """每日一檔：<root>/YYYYMMDD.snap"""
+    if not isinstance(day, str):
+        day = day.strftime("%Y%m%d")
+    return os.path.join(root, f"{day.replace('-', '')}.snap")
+
+
+def snapshots_to_array(snapshots):
+    """將 Shioaji snapshot 物件列表轉為 SNAPSHOT_DTYPE 陣列"""
+    n = len(snapshots)
+    arr = np.empty(n, dtype=SNAPSHOT_DTYPE)
+    arr["code"] = [s.code.encode() for s in snapshots]
+    arr["ts"] = np.fromiter((getattr(s, "ts", 0) for s in snapshots), dtype=np.int64, count=n)
+    arr["close"] = np.fromiter((s.close for s in snapshots), dtype=np.float64, count=n)
+    arr["high"] = np.fromiter((getattr(s, "high", 0.0) for s in snapshots), dtype=np.float64, count=n)
+    arr["low"] = np.fromiter((getattr(s, "low", 0.0) for s in snapshots), dtype=np.float64, count=n)
+    arr["volume"] = np.fromiter((getattr(s, "total_volume", 0) for s in snapshots), dtype=np.int64, count=n)
+    arr["bid"] = np.fromiter((getattr(s, "buy_price", 0.0) for s in snapshots), dtype=np.float64, count=n)
+    arr["ask"] = np.fromiter((getattr(s, "sell_price", 0.0) for s in snapshots), dtype=np.float64, count=n)
+    return arr
+
+
+class SnapshotRecorder:
+    """
+    只增不改的快照紀錄器。
+    監控迴圈呼叫 record() 只把物件放進佇列 (O(1))，轉換與寫檔由背景執行緒批次處理，
+    並依日期切換檔案。
+    """
+
+    def __init__(self, root=DEFAULT_ROOT, flush_interval=1.0):
+        self.root = root
+        self.flush_interval = flush_interval
+        self.queue = queue.SimpleQueue()
+        self.rows_written = 0
+        self.errors = 0
+        self._flushed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="snapshot-recorder", daemon=True)
+        self._thread.start()
+
+    def record(self, snapshots, day=None):
+        """放入一輪的快照 (不做任何轉換)"""
+        if snapshots:
+            self.queue.put((day or datetime.now().strftime("%Y%m%d"), snapshots))
+
+    def flush(self, timeout=5.0):
+        """等待目前佇列中的資料寫入磁碟"""
+        self._flushed.clear()
+        self.queue.put(("flush", None))
+        return self._flushed.wait(timeout)
+
+    def close(self, timeout=5.0):
+        self.queue.put(("close", None))
+        self._thread.join(timeout)
+
+    def _write(self, pending):
+        os.makedirs(self.root, exist_ok=True)
+        for day, batches in pending.items():
+            snaps = [s for batch in batches for s in batch]
+            arr = snapshots_to_array(snaps)
+            with open(snapshot_path(day, self.root), "ab") as f:
+                f.write(arr.tobytes())
+            self.rows_written += len(arr)
+        pending.clear()
+
+    def _run(self):
+        pending = {}
+        last_write = time.monotonic()
+        while True:
+            try:
+                day, snaps = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                day, snaps = None, None
+
+            if snaps is not None:
+                pending.setdefault(day, []).append(snaps)
+                if time.monotonic() - last_write < self.flush_interval:
+                    continue
+
+            try:
+                if pending:
+                    self._write(pending)
+            except Exception:
+                # 紀錄失敗不影響監控，捨棄此批
+                self.errors += 1
+                pending.clear()
+            last_write = time.monotonic()
+
+            if day == "flush":
+                self._flushed.set()
+            elif day == "close":
+                self._flushed.set()
+                return
+
+
+def load_snapshots(day, root=DEFAULT_ROOT):
+    """
+    以 memmap 零拷貝讀取某日的快照紀錄 (唯讀)。
+    尾端若有寫到一半的紀錄會被忽略。
+    """
+    path = snapshot_path(day, root)
+    if not os.path.exists(path):
+        return np.empty(0, dtype=SNAPSHOT_DTYPE)
+    count = os.path.getsize(path) // SNAPSHOT_DTYPE.itemsize
+    if count == 0:
+        return np.empty(0, dtype=SNAPSHOT_DTYPE)
+    return np.memmap(path, dtype=SNAPSHOT_DTYPE, mode="r", shape=(count,))
+
+
+def snapshots_frame(day, code=None, root=DEFAULT_ROOT):
+    """轉為 DataFrame (index 為時間)，可只取單一代碼"""
+    arr = load_snapshots(day, root)
+    if code is not None:
+        arr = arr[arr["code"] == code.encode()]
+    df = pd.DataFrame({name: arr[name] for name in SNAPSHOT_DTYPE.names if name != "code"})
+    df.insert(0, "code", arr["code"].astype(str))
+    df.index = pd.to_datetime(df.pop("ts"), unit="ns")
+    return df
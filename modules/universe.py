@@ -0,0 +1,219 @@
+import io
+import multiprocessing as mp
+import queue
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from .data_source import backoff_delay
+from .exit_rules import compile_rules
+
+SCANNER_TYPES = {
+    "成交量排行": "VolumeRank",
+    "成交金額排行": "AmountRank",
+    "漲幅排行": "ChangePercentRank",
+    "振幅排行": "DayRangeRank",
+    "成交筆數排行": "TickCountRank",
+}
+
+SNAPSHOT_CHUNK = 500  # Shioaji snapshots 單次上限
+
+
+def load_universe_file(file):
+    """
+    由使用者提供的檔案讀取代碼清單。
+    支援純文字 (每行一檔，或逗號/空白分隔) 與 CSV (取「代碼」/ code 欄，否則第一欄)。
+    """
+    raw = file.read() if hasattr(file, "read") else open(file, "rb").read()
+    text = raw.decode("utf-8-sig") if isinstance(raw, bytes) else raw
+    name = getattr(file, "name", str(file))
+    if name.lower().endswith(".csv"):
+        df = pd.read_csv(io.StringIO(text), dtype=str)
+        col = next((c for c in ("代碼", "code", "Code") if c in df.columns), df.columns[0])
+        codes = df[col].dropna().str.strip().tolist()
+    else:
+        codes = text.replace(",", " ").split()
+    # 去除重複並保留順序
+    return list(dict.fromkeys(c for c in codes if c))
+
+
+def scan_universe(api, scanner_name="成交量排行", count=200):
+    """以 Shioaji 排行榜 (scanners) 取得候選代碼"""
+    from shioaji import constant
+    scanner_type = getattr(constant.ScannerType, SCANNER_TYPES[scanner_name])
+    items = api.scanners(scanner_type=scanner_type, ascending=False, count=count)
+    return [item.code for item in items]
+
+
+def shard(codes, n):
+    """以輪流分配 (round-robin) 切成 n 份，讓各 shard 大小相近"""
+    n = max(1, min(n, len(codes)))
+    return [codes[i::n] for i in range(n)]
+
+
+def watch_worker(shard_id, codes, credentials, params, out_queue, stop_event):
+    """
+    觀察清單工作行程：自行登入 Shioaji，對自己的 shard 反覆抓取快照並計算訊號，
+    每輪將結果 (numpy 欄位) 放入 out_queue。
+    """
+    import shioaji as sj
+    from .data_source import MarketData, ShioajiSource, YFinanceSource
+
+    def emit(kind, payload):
+        try:
+            out_queue.put_nowait((shard_id, kind, payload))
+        except queue.Full:
+            pass
+
+    try:
+        api = sj.Shioaji(simulation=credentials.get("simulation", True))
+        api.login(api_key=credentials["api_key"], secret_key=credentials["secret_key"])
+    except Exception as e:
+        emit("error", f"shard {shard_id} 登入失敗: {e}")
+        return
+
+    md = MarketData([ShioajiSource(api), YFinanceSource()])
+    contracts = [c for c in (api.Contracts.Stocks.get(code) for code in codes) if c]
+    codes = [c.code for c in contracts]
+    index = {code: i for i, code in enumerate(codes)}
+    n = len(codes)
+
+    book = compile_rules({code: {"cost": 0.0} for code in codes}, params["trailing_stop"])
+    close = np.zeros(n)
+    day_high = np.zeros(n)
+    run_high = np.zeros(n)
+    change = np.zeros(n)
+    volume = np.zeros(n, dtype=np.int64)
+    errors = 0
+
+    while not stop_event.is_set():
+        started = time.perf_counter()
+        try:
+            for i in range(0, n, SNAPSHOT_CHUNK):
+                snapshots, source = md.call("quotes", contracts[i:i + SNAPSHOT_CHUNK])
+                if snapshots is None:
+                    raise RuntimeError(source)
+                for snap in snapshots:
+                    j = index.get(snap.code)
+                    if j is None or not snap.close:
+                        continue
+                    close[j] = snap.close
+                    day_high[j] = getattr(snap, "high", snap.close)
+                    change[j] = getattr(snap, "change_rate", 0.0)
+                    volume[j] = getattr(snap, "total_volume", 0)
+            np.maximum(run_high, close, out=run_high)
+
+            # 出場訊號：與庫存相同的移動停損 (自觀察開始的最高價)
+            exit_flag = np.zeros(n, dtype=bool)
+            rows, _, _ = book.evaluate(close, run_high)
+            exit_flag[rows] = True
+            # 進場訊號：漲幅達門檻且接近當日高點
+            entry_flag = (close > 0) & (change >= params["entry_change"]) & \
+                (close >= day_high * (1 - params["near_high_pct"] / 100))
+
+            emit("data", {
+                "codes": codes, "close": close.copy(), "high": run_high.copy(),
+                "change": change.copy(), "volume": volume.copy(),
+                "entry": entry_flag, "exit": exit_flag,
+                "cycle_ms": (time.perf_counter() - started) * 1000,
+                "ts": datetime.now().strftime("%H:%M:%S"),
+            })
+            errors = 0
+            stop_event.wait(params.get("interval", 3.0))
+        except Exception as e:
+            emit("error", f"shard {shard_id} 錯誤: {e}")
+            stop_event.wait(3 + backoff_delay(errors, base=2.0))
+            errors += 1
+
+    try:
+        api.logout()
+    except Exception:
+        pass
+
+
+class UniverseManager:
+    """
+    觀察清單管理：將候選代碼切成多個 shard，各由一個工作行程監看，
+    主程式 (Streamlit) 定期 poll() 合併各 shard 最新結果。
+    """
+
+    def __init__(self):
+        self.ctx = mp.get_context("spawn")
+        self.processes = []
+        self.stop_event = None
+        self.queue = None
+        self.latest = {}   # shard_id -> 最新一輪結果
+        self.errors = []
+
+    @property
+    def running(self):
+        return any(p.is_alive() for p in self.processes)
+
+    def start(self, codes, n_workers, credentials, params):
+        self.stop()
+        self.stop_event = self.ctx.Event()
+        self.queue = self.ctx.Queue(maxsize=n_workers * 8)
+        self.latest = {}
+        self.errors = []
+        for shard_id, shard_codes in enumerate(shard(codes, n_workers)):
+            p = self.ctx.Process(
+                target=watch_worker,
+                args=(shard_id, shard_codes, credentials, params, self.queue, self.stop_event),
+                daemon=True,
+                name=f"watch-shard-{shard_id}",
+            )
+            p.start()
+            self.processes.append(p)
+
+    def stop(self, timeout=5.0):
+        if self.stop_event is not None:
+            self.stop_event.set()
+        for p in self.processes:
+            p.join(timeout)
+            if p.is_alive():
+                p.terminate()
+        self.processes = []
+
+    def poll(self):
+        """取出佇列中所有結果，每個 shard 只保留最新一輪"""
+        if self.queue is None:
+            return
+        while True:
+            try:
+                shard_id, kind, payload = self.queue.get_nowait()
+            except (queue.Empty, OSError, ValueError):
+                break
+            if kind == "data":
+                self.latest[shard_id] = payload
+            else:
+                self.errors.insert(0, payload)
+                del self.errors[50:]
+
+    def view(self, held_codes=()):
+        """合併各 shard 結果為一張表"""
+        frames = []
+        for shard_id, r in sorted(self.latest.items()):
+            frames.append(pd.DataFrame({
+                "代碼": r["codes"], "現價": r["close"], "觀察最高價": r["high"],
+                "漲跌幅%": r["change"], "成交量": r["volume"],
+                "進場訊號": r["entry"], "出場訊號": r["exit"],
+                "shard": shard_id, "更新時間": r["ts"],
+            }))
+        if not frames:
+            return pd.DataFrame()
+        df = pd.concat(frames, ignore_index=True)
+        df.insert(1, "持有", df["代碼"].isin(set(held_codes)))
+        return df.sort_values(["進場訊號", "出場訊號", "漲跌幅%"], ascending=False, ignore_index=True)
+
+    def codes(self):
+        """目前觀察中的所有代碼"""
+        return [code for _, r in sorted(self.latest.items()) for code in r["codes"]]
+
+    def stats(self):
+        """各 shard 檔數與每輪耗時"""
+        return {
+            shard_id: {"檔數": len(r["codes"]), "每輪(ms)": round(r["cycle_ms"], 1)}
+            for shard_id, r in self.latest.items()
+        }